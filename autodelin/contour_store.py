@@ -0,0 +1,191 @@
+"""
+On-disk contour store. A contour shapefile is converted once with build_store() into packed coordinate arrays that are
+memory mapped by ContourStore. Loading is near instant, Contours.get() decodes contours as views of the mapped
+coordinates without copying, and SMP workers forked after loading share the mapped pages.
+
+Store layout (directory):
+    meta.json           - format version, source file size/mtime, elevation field and crs
+    elevations.npy      - (F,) float64 - contour elevations, sorted
+    feature_parts.npy   - (F, 2) int64 - parts of contour i are parts[start:stop]
+    part_offsets.npy    - (P + 1,) int64 - vertices of part j are coords[part_offsets[j]:part_offsets[j + 1]]
+    bounds.npy          - (P, 4) float64 - minx, miny, maxx, maxy of each part
+    coords.bin          - (N, 2) float64 - raw vertex coordinates, z values are dropped
+"""
+import json
+import os
+import numpy as np
+from lazy_import import LazyModule
+
+fiona = LazyModule('fiona')
+
+FORMAT_VERSION = 1
+
+META = 'meta.json'
+ELEVATIONS = 'elevations.npy'
+FEATURE_PARTS = 'feature_parts.npy'
+PART_OFFSETS = 'part_offsets.npy'
+BOUNDS = 'bounds.npy'
+COORDS = 'coords.bin'
+
+
+class StoreError(Exception):
+    pass
+
+
+class ContourStore(object):
+    """
+    Memory mapped contour store created by build_store()
+    """
+    def __init__(self, store_dir):
+        """
+        :param store_dir: string - store directory
+        """
+        self.store_dir = store_dir
+        self.meta = read_meta(store_dir)
+        if self.meta is None:
+            raise StoreError(store_dir + ' is not a contour store.')
+        if self.meta['version'] != FORMAT_VERSION:
+            raise StoreError(store_dir + ' is store version ' + str(self.meta['version']) + ', expected ' +
+                             str(FORMAT_VERSION) + '. Rebuild it with build_store().')
+        self.crs = self.meta['crs']
+
+        self.elevations = np.load(os.path.join(store_dir, ELEVATIONS))
+        self.feature_parts = np.load(os.path.join(store_dir, FEATURE_PARTS))
+        self.part_offsets = np.load(os.path.join(store_dir, PART_OFFSETS))
+        self.bounds = np.load(os.path.join(store_dir, BOUNDS))
+        if self.part_offsets[-1] > 0:
+            self.coords = np.memmap(os.path.join(store_dir, COORDS), dtype=np.float64, mode='r',
+                                    shape=(int(self.part_offsets[-1]), 2))
+        else:
+            self.coords = np.empty((0, 2))
+
+    def __len__(self):
+        return len(self.elevations)
+
+    def parts(self, feature, bbox=None):
+        """
+        Returns coordinates of the parts of a contour as views of the mapped coordinate array
+        :param feature: int - index of contour in self.elevations
+        :param bbox: (minx, miny, maxx, maxy) - only return parts whose bounds overlap bbox, None for all parts
+        :return: list of (N, 2) arrays
+        """
+        start, stop = self.feature_parts[feature]
+        offsets = self.part_offsets[start:stop + 1]
+        if bbox is None:
+            return [self.coords[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        keep = np.nonzero(bounds_overlap(self.bounds[start:stop], bbox))[0]
+        return [self.coords[offsets[i]:offsets[i + 1]] for i in keep.tolist()]
+
+    def features_in_range(self, elevation_range=None):
+        """
+        Returns indices of contours with elevations in elevation_range
+        :param elevation_range: (min, max) - inclusive, None for all contours
+        :return: list of int
+        """
+        if elevation_range is None:
+            return range(len(self.elevations))
+        low = np.searchsorted(self.elevations, elevation_range[0], side='left')
+        high = np.searchsorted(self.elevations, elevation_range[1], side='right')
+        return range(int(low), int(high))
+
+
+def build_store(contour_file, elev_field, store_dir, chatty=False):
+    """
+    Converts contour shapefile to a contour store. Contours are assumed to be dissolved by elevation. If more than
+    one feature has the same elevation the last one is used, same as Manager.import_contours()
+    :param contour_file: string - name of contour shapefile
+    :param elev_field: string - attribute field with contour elevations
+    :param store_dir: string - store directory, created if it doesn't exist
+    :param chatty: boolean - True prints progress to stdout
+    """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    elif os.path.exists(os.path.join(store_dir, META)):
+        # Mark store incomplete until the rebuild is done
+        os.remove(os.path.join(store_dir, META))
+
+    features = {}       # elevation: (first part, last part + 1)
+    part_offsets = [0]
+    bounds = []
+    with fiona.collection(contour_file, 'r') as input_file:
+        crs = input_file.crs
+        with open(os.path.join(store_dir, COORDS), 'wb') as coords_file:
+            for feature in input_file:
+                elev = feature['properties'][elev_field]
+                geo = feature['geometry']
+                if geo['type'] == 'MultiLineString':
+                    parts = geo['coordinates']
+                elif geo['type'] == 'LineString':
+                    parts = [geo['coordinates']]
+                else:
+                    raise StoreError('Contour file does not appear to contain lines.')
+
+                first_part = len(bounds)
+                for part in parts:
+                    coords = np.array(part, dtype=np.float64)[:, :2]
+                    coords.tofile(coords_file)
+                    part_offsets.append(part_offsets[-1] + len(coords))
+                    bounds.append(np.concatenate((coords.min(axis=0), coords.max(axis=0))))
+                features[elev] = (first_part, len(bounds))
+
+                if chatty and len(features) % 25 == 0:
+                    print len(features), 'contours converted...'
+
+    elevations = sorted(features)
+    np.save(os.path.join(store_dir, ELEVATIONS), np.array(elevations, dtype=np.float64))
+    np.save(os.path.join(store_dir, FEATURE_PARTS), np.array([features[x] for x in elevations],
+                                                             dtype=np.int64).reshape(-1, 2))
+    np.save(os.path.join(store_dir, PART_OFFSETS), np.array(part_offsets, dtype=np.int64))
+    np.save(os.path.join(store_dir, BOUNDS), np.array(bounds, dtype=np.float64).reshape(-1, 4))
+
+    # Written last, a store without meta.json is incomplete
+    source = os.stat(contour_file)
+    meta = {'version': FORMAT_VERSION,
+            'source': os.path.abspath(contour_file),
+            'source_size': source.st_size,
+            'source_mtime': source.st_mtime,
+            'elev_field': elev_field,
+            'crs': crs}
+    with open(os.path.join(store_dir, META), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    if chatty:
+        print len(elevations), 'contours converted to', store_dir
+
+
+def bounds_overlap(bounds, bbox):
+    """
+    Tests part bounds against bbox
+    :param bounds: (P, 4) array - minx, miny, maxx, maxy of each part
+    :param bbox: (minx, miny, maxx, maxy)
+    :return: (P,) boolean array
+    """
+    minx, miny, maxx, maxy = bbox
+    return (bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) & (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny)
+
+
+def read_meta(store_dir):
+    """
+    Returns store metadata or None if store_dir isn't a complete store
+    :param store_dir: string - store directory
+    :return: dict or None
+    """
+    try:
+        with open(os.path.join(store_dir, META)) as meta_file:
+            return json.load(meta_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def is_current(store_dir, contour_file, elev_field):
+    """
+    Returns True if store_dir is a complete store built from the current version of contour_file with elev_field
+    :param store_dir: string - store directory
+    :param contour_file: string - name of contour shapefile
+    :param elev_field: string - attribute field with contour elevations
+    :return: boolean
+    """
+    meta = read_meta(store_dir)
+    if meta is None or meta.get('version') != FORMAT_VERSION or meta.get('elev_field') != elev_field:
+        return False
+    source = os.stat(contour_file)
+    return meta['source_size'] == source.st_size and meta['source_mtime'] == source.st_mtime
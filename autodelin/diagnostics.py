@@ -0,0 +1,115 @@
+"""
+Diagnostic sinks for draw_line_between_contours(). The default NullSink does nothing. TraceRecorder saves the
+intermediate geometry of every segment to a compressed .npz file that can be rendered offline with plot_trace.py
+
+Usage:
+    import autodelin.geo_tools as gt
+    import autodelin.diagnostics as diag
+    gt.set_diagnostics(diag.TraceRecorder('traces'))
+"""
+import os
+import re
+import itertools
+import numpy as np
+
+# Keys used in trace files
+LOW_CONTOUR = 'low_contour'
+HIGH_CONTOUR = 'high_contour'
+RAW_LINES = 'raw_lines'
+CROSSING_LINES = 'crossing_lines'
+REFINEMENT = 'refinement'
+BOUNDARY = 'boundary'
+
+# Trace file numbers for this process. Module level because the recorder is pickled with every segment sent to SMP
+# workers
+_trace_numbers = itertools.count(1)
+
+
+class NullSink(object):
+    """
+    Default diagnostics sink, ignores everything. Callers should check self.enabled before building geometry for the
+    sink so that disabled diagnostics cost nothing.
+    """
+    enabled = False
+
+    def begin(self, name):
+        """
+        Starts trace for a new segment
+        :param name: string - segment name
+        """
+        pass
+
+    def add(self, key, geometry):
+        """
+        Adds geometry to the current trace
+        :param key: string - one of the key constants in this module
+        :param geometry: ADPolyline, list of ADPolylines or array of coordinates
+        """
+        pass
+
+    def end(self):
+        """ Finishes trace for current segment """
+        pass
+
+
+class TraceRecorder(NullSink):
+    """
+    Saves intermediate geometry for each segment to out_dir/<segment name>-<pid>-<number>.npz. Coordinates are
+    stored as float arrays: contours and the boundary as (N, 2), crossing lines as (N, 2, 2) and refinement test
+    points as (iterations, N, 2). Safe to use with SMP, each process writes its own files.
+    """
+    enabled = True
+
+    def __init__(self, out_dir):
+        """
+        :param out_dir: string - directory for trace files, created if it doesn't exist
+        """
+        self.out_dir = out_dir
+        self.name = None
+        self.geometry = {}
+
+    def begin(self, name):
+        self.name = name
+        self.geometry = {}
+
+    def add(self, key, geometry):
+        if key == REFINEMENT:
+            # Collect test points from every iteration
+            self.geometry.setdefault(key, []).append(_to_array(geometry))
+        else:
+            self.geometry[key] = _to_array(geometry)
+
+    def end(self):
+        if not os.path.isdir(self.out_dir):
+            try:
+                os.makedirs(self.out_dir)
+            except OSError:
+                # Another process beat us to it
+                pass
+        name = re.sub(r'[^\w.]+', '_', str(self.name or 'segment'))
+        name += '-' + str(os.getpid()) + '-' + str(next(_trace_numbers)) + '.npz'
+        file_name = os.path.join(self.out_dir, name)
+        np.savez_compressed(file_name, **_stack(self.geometry))
+        self.name = None
+        self.geometry = {}
+
+
+def _to_array(geometry):
+    """
+    Converts geometry to array of coordinates
+    :param geometry: ADPolyline, list of ADPolylines, list of (X, Y) tuples or array
+    :return: array
+    """
+    if hasattr(geometry, 'coords'):
+        return np.asarray(geometry.coords)
+    if type(geometry) is list and geometry and hasattr(geometry[0], 'coords'):
+        return np.array([line.coords for line in geometry])
+    return np.asarray(geometry)
+
+
+def _stack(geometry):
+    """ Stacks refinement iterations into one array """
+    stacked = dict(geometry)
+    if REFINEMENT in stacked:
+        stacked[REFINEMENT] = np.array(stacked[REFINEMENT])
+    return stacked
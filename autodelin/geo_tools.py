@@ -1,9 +1,24 @@
 from shapely.geometry import LineString, Point, MultiPoint, GeometryCollection
-from matplotlib import pyplot
-import copy
+from shapely.strtree import STRtree
+import numpy as np
+import heapq
+import diagnostics as diag
+import instrumentation as inst
+from lazy_import import LazyModule
+
+pyplot = LazyModule('matplotlib.pyplot')
 
 PRECISION = 5
 
+# Crossing line engines for draw_line_between_contours(). See segment.Segment
+SHAPELY = 'shapely'
+NUMPY = 'numpy'
+
+# Refinement of boundary positions along crossing lines stops when no position moves more than REFINE_TOLERANCE
+# (normalized distance along the crossing line) or after REFINE_MAX_ITERATIONS passes. See refine_positions()
+REFINE_TOLERANCE = 1e-4
+REFINE_MAX_ITERATIONS = 10
+
 DEBUG1 = False
 DEBUG2 = False
 DEBUG_X_LINES_1_N_2 = False
@@ -11,9 +26,57 @@ DEBUG_same_as = False
 DEBUG_x_line_dist = False
 DEBUG_zig_zag = False
 DEBUG_draw_xlines = False
-DEBUG_draw_xlines_B = True
 DEBUG_contour_loop = False
-DEBUG_draw_contour = True
+
+# Diagnostics sink for draw_line_between_contours(), see diagnostics.py. Set with set_diagnostics()
+DIAGNOSTICS = diag.NullSink()
+
+
+def set_diagnostics(sink):
+    """
+    Sets diagnostics sink used by segments created from now on
+    :param sink: diagnostics.NullSink or diagnostics.TraceRecorder, None to disable
+    """
+    global DIAGNOSTICS
+    if sink is None:
+        sink = diag.NullSink()
+    DIAGNOSTICS = sink
+
+
+# Stage timers and counters, see instrumentation.py. Set with set_instruments()
+INSTRUMENTS = inst.NullInstruments()
+
+
+def set_instruments(instruments):
+    """
+    Sets instruments used by segments created from now on
+    :param instruments: instrumentation.Instruments, None to disable
+    """
+    global INSTRUMENTS
+    if instruments is None:
+        instruments = inst.NullInstruments()
+    INSTRUMENTS = instruments
+
+
+# Shapely operations made in this process by ADPolyline, ADPoint, FilterCrossingLines and Contour part lookups,
+# counted where they are called. Always counted, instruments record the difference across each segment job
+_SHAPELY_CALLS = [0]
+
+
+def shapely_calls():
+    """
+    Returns number of shapely operations made so far in this process
+    :return: int
+    """
+    return _SHAPELY_CALLS[0]
+
+
+def count_shapely_calls(n=1):
+    """
+    Adds n shapely operations made outside this module, see shapely_calls()
+    :param n: int
+    """
+    _SHAPELY_CALLS[0] += n
 
 
 class UnknownIntersection(Exception):
@@ -25,43 +88,35 @@ class NoIntersection(Exception):
 
 
 class ADPolyline(object):
-    def __init__(self, shapely_geo=None, vertices=None, use_arcpy=False, use_shapely=False):
+    def __init__(self, shapely_geo=None, vertices=None, coords=None, use_arcpy=False, use_shapely=False):
         """
-        Can be initiated with either a shapely Linestring or a list of ADPoints (vertices)
+        Can be initiated with either a shapely Linestring, a list of ADPoints (vertices) or an array of coordinates.
+        Vertices are stored as a (N, 2) float64 array in self.coords. The shapely geometry is only built when first
+        used and ADPoints are only created when asked for (self.vertices, self.first_point, self.last_point)
         :param shapely_geo: Linestring object
         :param vertices: list of ADPoint objects
+        :param coords: (N, 2) array or sequence of (X, Y) tuples
         :param use_arcpy: not implemented yet
         :param use_shapely: default
         :return: None
         """
-        if vertices is not None and shapely_geo is None:
-            # vertices supplied, create geo
+        if vertices is not None and shapely_geo is None and coords is None:
+            # vertices supplied
             # assume vertices are all ADPoint
-            self.vertices = vertices
-            self.__geo_from_vertices(vertices)
-        elif vertices is None and shapely_geo is not None:
-            # Extract vertices from shapely geo
-            self.vertices = []
-            self.shapely_geo = shapely_geo
-            # Make coordinates python friendly
-            coord_list = list(shapely_geo.coords)
-
-            if len(coord_list[0]) == 2:
-                # 2d linestring
-                for x, y in coord_list:
-                    vertex = ADPoint(x, y)
-                    self.vertices.append(vertex)
-            elif len(coord_list[0]) == 3:
-                # 3d linestring - ignore z value
-                for x, y, _ in coord_list:
-                    vertex = ADPoint(x, y)
-                    self.vertices.append(vertex)
-            self.first_point = self.vertices[0]
-            self.last_point = self.vertices[-1]
+            self.coords = np.array([(vertex.X, vertex.Y) for vertex in vertices], dtype=float)
+        elif vertices is None and shapely_geo is not None and coords is None:
+            # Extract coordinates from shapely geo, ignore z values
+            self.coords = np.array(shapely_geo.coords, dtype=float)[:, :2].copy()
+        elif vertices is None and shapely_geo is None and coords is not None:
+            # Use array as is if possible, this allows views of a larger array
+            self.coords = np.ascontiguousarray(coords, dtype=float)[:, :2]
         else:
             # got nothing, bail
             raise
 
+        if len(self.coords) < 2:
+            raise ValueError('LineStrings must have at least 2 coordinate tuples')
+
         # Only allowed to use arcpy or shapely
         if use_arcpy and use_arcpy:
             raise
@@ -74,16 +129,58 @@ class ADPolyline(object):
         if use_shapely:
             pass
 
-        self.length = self.shapely_geo.length
+        # Built on first use
+        self._shapely_geo = None
+        self._length = None
+        self._station_table = None
 
-    def __geo_from_vertices(self, vertices):
-        temp_vertices = []
-        for vertex in vertices:
-            temp_vertex = (vertex.X, vertex.Y)
-            temp_vertices.append(temp_vertex)
-        self.shapely_geo = LineString(temp_vertices)
-        self.first_point = self.vertices[0]
-        self.last_point = self.vertices[-1]
+    def __getstate__(self):
+        """
+        Pickle coordinates only, shapely geometry, length and stations are rebuilt on first use after unpickling
+        """
+        state = self.__dict__.copy()
+        state['coords'] = np.asarray(self.coords)
+        state['_shapely_geo'] = None
+        state['_length'] = None
+        state['_station_table'] = None
+        return state
+
+    @property
+    def shapely_geo(self):
+        """ shapely LineString, built from self.coords on first use """
+        if self._shapely_geo is None:
+            self._shapely_geo = LineString(self.coords)
+        return self._shapely_geo
+
+    @property
+    def vertices(self):
+        """ list of ADPoints, created on every call. Use self.coords where possible """
+        return [ADPoint(x, y) for x, y in self.coords.tolist()]
+
+    @property
+    def first_point(self):
+        x, y = self.coords[0].tolist()
+        return ADPoint(x, y)
+
+    @property
+    def last_point(self):
+        x, y = self.coords[-1].tolist()
+        return ADPoint(x, y)
+
+    @property
+    def length(self):
+        if self._length is None:
+            self._length = float(self._stations()[-1])
+        return self._length
+
+    def _stations(self):
+        """ Returns array of distances along self to each vertex. Calculated on first use, don't modify """
+        if self._station_table is None:
+            stations = np.zeros(len(self.coords))
+            deltas = np.diff(self.coords, axis=0)
+            stations[1:] = np.cumsum(np.sqrt((deltas ** 2).sum(axis=1)))
+            self._station_table = stations
+        return self._station_table
 
     def __str__(self):
         s = ''
@@ -92,6 +189,7 @@ class ADPolyline(object):
         return s[:-2]
 
     def crosses(self, line):
+        _SHAPELY_CALLS[0] += 1
         return self.shapely_geo.crosses(line.shapely_geo)
 
     def is_same_as(self, polyline):
@@ -99,8 +197,8 @@ class ADPolyline(object):
             raise  # something
         if DEBUG_same_as:
             print 'comparing 2 polylines'
-        for vertex1, vertex2 in zip(self.vertices, polyline.vertices):
-            if not vertex1.is_same_as(vertex2):
+        for (x1, y1), (x2, y2) in zip(self.coords.tolist(), polyline.coords.tolist()):
+            if round(x1, PRECISION) != round(x2, PRECISION) or round(y1, PRECISION) != round(y2, PRECISION):
                 return False
         return True
 
@@ -110,6 +208,7 @@ class ADPolyline(object):
         :param polyline: ADPolyline
         :return: ADPoint, list of ADPoints or None
         """
+        _SHAPELY_CALLS[0] += 1
         new_geo = self.shapely_geo.intersection(polyline.shapely_geo)
         if type(new_geo) is Point:
             return ADPoint(shapely_geo=new_geo)
@@ -173,24 +272,28 @@ class ADPolyline(object):
             return 0
 
     def point_at_distance(self, distance, normalize=False):
+        _SHAPELY_CALLS[0] += 1
         new_pt = self.shapely_geo.interpolate(distance, normalized=normalize)
         return ADPoint(shapely_geo=new_pt)
 
     def distance_to(self, gis_thing):
         #print type(gis_thing)
+        _SHAPELY_CALLS[0] += 1
         return self.shapely_geo.distance(gis_thing.shapely_geo)
 
     def interpolate(self, distance, normalized=False):
         """ Returns ADPoint at distance along polyline """
+        _SHAPELY_CALLS[0] += 1
         geo = self.shapely_geo.interpolate(distance, normalized)
         return ADPoint(shapely_geo=geo)
 
     def project(self, gis_thing):
         """Returns the distance along this geometric object to a point nearest the other object."""
+        _SHAPELY_CALLS[0] += 1
         return self.shapely_geo.project(gis_thing.shapely_geo)
 
     def plot(self, *args, **kwargs):
-        pyplot.plot(self.shapely_geo.xy[0], self.shapely_geo.xy[1], *args, **kwargs)
+        pyplot.plot(self.coords[:, 0], self.coords[:, 1], *args, **kwargs)
 
     def label(self, text='insert text here', reverse=False, *args, **kwargs):
         if reverse:
@@ -210,77 +313,39 @@ class ADPolyline(object):
         :param point2: ADPoint
         :return: ADPolyline
         """
-        # Don't screw up the real vertex order
-        vertices = copy.copy(self.vertices)
-
         if DEBUG_contour_loop:
-            print '..before sort start/end vertices', vertices[0], vertices[-1]
+            print '..before sort start/end vertices', self.first_point, self.last_point
         # Check for loop contour
-        if vertices[-1].is_same_as(vertices[0]):
-            loop_flag = True
-        else:
-            loop_flag = False
-
-        # tag existing vertices
-        for vertex in vertices:
-            vertex.flag = False
-        # tag new vertices
-        point1.flag = True
-        point2.flag = True
-
-        # calculate distances for contour vertices the fast way
-        last_point = vertices[0]
-        last_point.station = 0
-        station = 0
-        for vertex in vertices[1:]:
-            station += vertex.distance(last_point)
-            vertex.station = station
-            last_point = vertex
-        # calculate distances for new vertices the slow way
-        point1.station = self.project(point1)
-        point2.station = self.project(point2)
-        vertices += [point1, point2]
-        # sort the vertices
-        vertices.sort(key=lambda x: x.station)
+        loop_flag = self.first_point.is_same_as(self.last_point)
 
-        if DEBUG_contour_loop:
-            print '..after sort start/end vertices', vertices[0], vertices[-1]
+        # Order clip points along the line, point1 first if they're at the same station
+        station1 = self.project(point1)
+        station2 = self.project(point2)
+        if station2 < station1:
+            point1, point2 = point2, point1
+            station1, station2 = station2, station1
+
+        # Cut indices by bisection of the vertex stations. Vertices at the same station as a clip point stay before it
+        stations = self._stations()
+        first = np.searchsorted(stations, station1, side='right')
+        last = np.searchsorted(stations, station2, side='right')
 
         # extract middle points, keep beginning and end of line for loop calcs
-        start_vertices = []
-        new_vertices = []
-        end_vertices = []
-        state = 'start'
-        for vertex in vertices:
-            if state == 'start' and vertex.flag is False:
-                # not one of our points
-                start_vertices.append(vertex)
-            elif state == 'start' and vertex.flag is True:
-                state = 'in'
-                new_vertices.append(vertex)
-            elif state == 'in' and vertex.flag is False:
-                new_vertices.append(vertex)
-            elif state == 'in' and vertex.flag is True:
-                # last vertex in middle
-                state = 'end'
-                new_vertices.append(vertex)
-            elif state == 'end':
-                end_vertices.append(vertex)
-
-        # outside portion of line, for loop contour tests
-        outside_vertices = end_vertices + start_vertices[1:]
+        new_vertices = np.empty((last - first + 2, 2))
+        new_vertices[0] = point1.X, point1.Y
+        new_vertices[1:-1] = self.coords[first:last]
+        new_vertices[-1] = point2.X, point2.Y
 
         if DEBUG_contour_loop:
-            print '..len vertices = ', len(vertices)
+            print '..len vertices = ', len(self.coords) + 2
             print '..len new_vertices = ', len(new_vertices)
-            print '..line outside_vertices = ', len(outside_vertices)
-            print '..start/end vertices', start_vertices[0], end_vertices[-1]
 
-        inside_line = ADPolyline(vertices=new_vertices)
+        inside_line = ADPolyline(coords=new_vertices)
 
         # Check for loop contour
         if loop_flag:
-            outside_line = ADPolyline(vertices=outside_vertices)
+            # outside portion of line, end of line then beginning, skipping the repeated first vertex
+            outside_line = ADPolyline(coords=np.vstack((self.coords[last:], self.coords[1:first])))
             # loop contour, see if outside is shorter
             if DEBUG_contour_loop:
                 print '..loop contour'
@@ -292,25 +357,51 @@ class ADPolyline(object):
             print '..returning inside line'
         return inside_line
 
+    def window(self, point1, point2):
+        """
+        Returns the part of self that clip(point1, point2) uses: the vertices between point1 and point2 plus one more
+        on each side. Clipping the result with the same points gives the same line. Loops are returned whole,
+        clip() can keep the outside of a loop
+        :param point1: ADPoint
+        :param point2: ADPoint
+        :return: ADPolyline
+        """
+        if self.first_point.is_same_as(self.last_point):
+            return self
+        station1 = self.project(point1)
+        station2 = self.project(point2)
+        if station2 < station1:
+            station1, station2 = station2, station1
+
+        # Same cut indices as clip(), widened by the vertex before and after so both clip points project the same
+        stations = self._stations()
+        count = len(self.coords)
+        first = min(max(np.searchsorted(stations, station1, side='right') - 1, 0), count - 2)
+        last = min(np.searchsorted(stations, station2, side='right') + 1, count)
+        if first == 0 and last == count:
+            return self
+        return ADPolyline(coords=self.coords[first:last])
+
     def flip(self):
-        self.vertices = self.vertices[::-1]
-        self.__geo_from_vertices(self.vertices)
+        self.coords = np.ascontiguousarray(self.coords[::-1])
+        self._shapely_geo = None
+        self._station_table = None
 
 
 class ADPoint(object):
     def __init__(self, X=None, Y=None, shapely_geo=None):
         if X is not None and Y is not None and shapely_geo is None:
-            # X and Y supplied, create geo
+            # X and Y supplied, geo is created on first use
             self.X = X
             self.Y = Y
-            self.shapely_geo = Point((self.X, self.Y))
+            self._shapely_geo = None
         elif X is None and Y is None and shapely_geo is not None:
             # Geometry supplied, extract X and Y
             if not isinstance(shapely_geo, Point):
                 raise
-            self.shapely_geo = shapely_geo
-            self.X = list(shapely_geo.coords)[0][0]
-            self.Y = list(shapely_geo.coords)[0][1]
+            self._shapely_geo = shapely_geo
+            self.X = shapely_geo.x
+            self.Y = shapely_geo.y
         elif X is not None and Y is not None and shapely_geo is not None:
             # Got both, see if they match
             geo_X = list(shapely_geo.coords)[0][0]
@@ -319,11 +410,24 @@ class ADPoint(object):
                 raise
             self.X = X
             self.Y = Y
-            self.shapely_geo = shapely_geo
+            self._shapely_geo = shapely_geo
         else:
             # Didn't get anything
             raise
 
+    def __getstate__(self):
+        """ Pickle X and Y only, shapely geometry is rebuilt on first use after unpickling """
+        state = self.__dict__.copy()
+        state['_shapely_geo'] = None
+        return state
+
+    @property
+    def shapely_geo(self):
+        """ shapely Point, built on first use """
+        if self._shapely_geo is None:
+            self._shapely_geo = Point((self.X, self.Y))
+        return self._shapely_geo
+
     def __str__(self):
         return '(' + str(self.X) + ', ' + str(self.Y) + ')'
 
@@ -354,11 +458,13 @@ class ADPoint(object):
         :param polyline: ADPolyline
         :return: ADPoint
         """
+        _SHAPELY_CALLS[0] += 2
         distance = polyline.shapely_geo.project(self.shapely_geo)
         new_pt = polyline.shapely_geo.interpolate(distance)
         return ADPoint(shapely_geo=new_pt)
 
     def distance_to(self, gis_thing):
+        _SHAPELY_CALLS[0] += 1
         return self.shapely_geo.distance(gis_thing.shapely_geo)
 
     def plot(self, *args, **kwargs):
@@ -373,12 +479,19 @@ class ADPoint(object):
 class FilterCrossingLines(object):
     """
     Used by _sort_lines() to remove intersecting crossing lines. Preferentially removes lines that
-    cross the most other lines. Each crossing line keeps a list (crossing list) of other lines it intersects. When a
-    crossing line is removed the crossing list for the other lines is intersects is up dated. This allows the removal
+    cross the most other lines. Each crossing line keeps a set (crossing set) of other lines it intersects. When a
+    crossing line is removed the crossing set for the other lines it intersects is updated. This allows the removal
     of the fewest number of lines.
+
+    Candidate pairs are found with an STRtree so only lines with overlapping envelopes are tested with crosses().
+    Lines are removed with greedy_filter(), see it for how ties are broken.
     """
     def __init__(self, lines):
         self.lines = lines
+        # self.crossing[i] is the set of indices of lines that self.lines[i] crosses
+        self.crossing = None
+        # Number of crosses() tests
+        self.tests = 0
 
     def filter(self):
         """
@@ -386,81 +499,94 @@ class FilterCrossingLines(object):
         :return: list of ADPolyline
         """
         self._calc_intersections()
-        while self._lines_cross():
-            self.lines.sort(key=lambda x: x.num_crosses)
-            self._remove_last_line()
+        self.lines = [self.lines[i] for i in greedy_filter(self.crossing)]
         assert self.lines != []
         return self.lines
 
     def _calc_intersections(self):
         """
-        Calculates number of intersections for each line in self.lines and which lines intersect.
-        Stores number of intersections in line.num_crosses
-        Stores list of intersecting ADPolylines in line.crossing_lines
+        Calculates which lines in self.lines intersect. Stores sets of indices of intersecting lines in
+        self.crossing
         """
-        for current_index, current_line in enumerate(self.lines):
-            current_line.num_crosses = 0
-            current_line.crossing_lines = []
-            # Test against all lines
-            for temp_index, temp_line in enumerate(self.lines):
-                if current_index == temp_index:
-                    # Ignore current line
+        self.crossing = [set() for _ in self.lines]
+        geos = [line.shapely_geo for line in self.lines]
+        index_of = dict((id(geo), i) for i, geo in enumerate(geos))
+        tree = STRtree(geos)
+        for current_index, current_geo in enumerate(geos):
+            for temp_geo in tree.query(current_geo):
+                temp_index = index_of[id(temp_geo)]
+                # Only test each pair once, crosses() is symmetric
+                if temp_index <= current_index:
                     continue
-                if current_line.crosses(temp_line):
-                    current_line.num_crosses += 1
-                    current_line.crossing_lines.append(temp_line)
-
-        # if not True:
-        #     for i in range(len(self.lines)):
-        #         self.lines[i].number = i
-        #
-        #     for line in self.lines:
-        #         print '\nline', line.number, 'intersects: ',
-        #         for other_line in line.crossing_lines:
-        #             print other_line.number, ', ',
-
-    def _lines_cross(self):
-        """
-        Returns true if num_crosses is > 0 for any line in self.lines, else false
-        :return: Bool
-        """
-        for line in self.lines:
-            if line.num_crosses > 0:
-                return True
-        return False
-
-    def _remove_last_line(self):
-        """
-        Removes last line from self.lines (pop(-1)). Updates num_crosses and intersect_lines for all lines
-        the last line intersects
-        """
-        # Remove last line
-        last_line = self.lines.pop(-1)
-
-        if last_line.num_crosses == 0 or last_line.crossing_lines == []:
-            raise NoIntersection
-
-        # print '\nremoving line', last_line.number
-        # print '\tline', last_line.number, 'intersects: ',
-        # for other_line in last_line.crossing_lines:
-        #     print other_line.number, ', ',
-
-        # Update all lines previously crossed by last_line
-        for current_line in last_line.crossing_lines:
-            current_line.num_crosses -= 1
-            assert current_line.num_crosses >= 0
-
-            # Remove reference to last_line
-            for i, test_line in enumerate(current_line.crossing_lines):
-                if test_line is last_line:
-                    current_line.crossing_lines.pop(i)
-                    break
-            else:
-                # Should never get here
-                raise Exception("should never get here")
+                self.tests += 1
+                if current_geo.crosses(temp_geo):
+                    self.crossing[current_index].add(temp_index)
+                    self.crossing[temp_index].add(current_index)
+        # One query per line and the crosses() tests
+        _SHAPELY_CALLS[0] += len(geos) + self.tests
 
 
-def draw_line_between_contours(low_contour, high_contour, last_pos, current_pos):
+def greedy_filter(crossing):
+    """
+    Removes crossing lines until no lines cross, always removing the line that crosses the most remaining lines.
+
+    This matches the original list based filter, which stable sorted the lines by number of crosses and removed the
+    last one, and so removes the same lines in the same order. Ties are broken by sort history: between lines with the
+    same number of crosses, the one that lost a cross most recently is removed first, then the one with the highest
+    index. Lines are kept in a heap keyed on (crosses, times a cross was lost, index). Entries are updated lazily, an
+    entry is skipped if its line was removed or has been pushed again since.
+    :param crossing: list of sets - crossing[i] is the set of indices of lines that line i crosses. Modified in place
+    :return: list of int - indices of remaining lines, in the order the original filter left them
+    """
+    num_crosses = [len(x) for x in crossing]
+    # Times (removal number) each line lost a cross, newest first, negated and ending with 0 so that longer histories
+    # sort first in the heap
+    history = [(0,) for _ in crossing]
+    version = [0] * len(crossing)
+    removed = [False] * len(crossing)
+
+    def entry(i):
+        return (-num_crosses[i], history[i], -i), version[i], i
+
+    heap = [entry(i) for i in range(len(crossing))]
+    heapq.heapify(heap)
+
+    time = 0
+    last_decremented = set()
+    while heap:
+        _, entry_version, last_line = heapq.heappop(heap)
+        if removed[last_line] or entry_version != version[last_line]:
+            continue
+        if num_crosses[last_line] == 0:
+            break
+
+        # Remove line and update all lines it crosses
+        time += 1
+        removed[last_line] = True
+        last_decremented = crossing[last_line]
+        for current_line in last_decremented:
+            num_crosses[current_line] -= 1
+            assert num_crosses[current_line] >= 0
+            crossing[current_line].remove(last_line)
+            history[current_line] = (-time,) + history[current_line]
+            version[current_line] += 1
+            heapq.heappush(heap, entry(current_line))
+
+    remaining = [i for i in range(len(crossing)) if not removed[i]]
+    if time == 0:
+        # Nothing removed, original order
+        return remaining
+
+    # The original filter last sorted the lines before the final removal, order by the heap keys at that point
+    def last_sort_key(i):
+        if i in last_decremented:
+            return -(num_crosses[i] + 1), history[i][1:], -i
+        return -num_crosses[i], history[i], -i
+    remaining.sort(key=last_sort_key, reverse=True)
+    return remaining
+
+
+def draw_line_between_contours(low_contour, high_contour, last_pos, current_pos, diagnostics=None, instruments=None):
     """
     Interpolates line from low contour to high_contour based on last_pos and current_pos
     :param low_contour: ADPolyline for lower elevation contour
@@ -468,8 +594,28 @@ def draw_line_between_contours(low_contour, high_contour, last_pos, current_pos)
     :param last_pos: float - position to begin at (first vertex) between high and low contour. Varies between 0.0 and
                     1.0. 0 indicates begin at lower contour, 0.999 is almost at high contour
     :param current_pos: float - position to end at (last vertex) between high and low contour
+    :param diagnostics: diagnostics sink, defaults to DIAGNOSTICS
+    :param instruments: stage timers and counters, defaults to INSTRUMENTS
     :return: ADPolyline object
     """
+    fan = crossing_line_fan(low_contour, high_contour, diagnostics, instruments)
+    return fan.boundary(last_pos, current_pos, diagnostics, instruments)
+
+
+def crossing_line_fan(low_contour, high_contour, diagnostics=None, instruments=None):
+    """
+    Creates, filters and sorts the crossing lines between low_contour and high_contour. The lines don't depend on the
+    boundary position, see CrossingLineFan.boundary()
+    :param low_contour: ADPolyline for lower elevation contour
+    :param high_contour: ADPolyline for higher elevation contour
+    :param diagnostics: diagnostics sink, defaults to DIAGNOSTICS
+    :param instruments: stage timers and counters, defaults to INSTRUMENTS
+    :return: CrossingLineFan
+    """
+    if diagnostics is None:
+        diagnostics = DIAGNOSTICS
+    if instruments is None:
+        instruments = INSTRUMENTS
     if DEBUG1:
         low_contour.vertices[0].plot(marker='o', color='black')
         high_contour.vertices[0].plot(marker='x', color='red')
@@ -483,17 +629,19 @@ def draw_line_between_contours(low_contour, high_contour, last_pos, current_pos)
             print 'contour2 points west'
         else:
             print 'contour2 points east'
-    if DEBUG_draw_contour:
-        high_contour.plot()
-        low_contour.plot()
+    if diagnostics.enabled:
+        diagnostics.add(diag.LOW_CONTOUR, low_contour)
+        diagnostics.add(diag.HIGH_CONTOUR, high_contour)
 
     # create perpendicular (crossing) lines from contour1 to contour2
     x_lines1 = []
-    for vertex in low_contour.vertices:
-        closest_point = vertex.closest_point(high_contour)
-        temp_line = ADPolyline(vertices=[vertex, closest_point])
-        x_lines1.append(temp_line)
-    x_lines1 = _remove_intersecting_lines(x_lines1, low_contour)
+    with instruments.stage(inst.CROSSING_LINES):
+        for vertex in low_contour.vertices:
+            closest_point = vertex.closest_point(high_contour)
+            temp_line = ADPolyline(vertices=[vertex, closest_point])
+            x_lines1.append(temp_line)
+    with instruments.stage(inst.REMOVE_INTERSECTING):
+        x_lines1 = _remove_intersecting_lines(x_lines1, low_contour)
     assert x_lines1 != []
 
     if DEBUG_X_LINES_1_N_2:
@@ -507,11 +655,13 @@ def draw_line_between_contours(low_contour, high_contour, last_pos, current_pos)
 
     # create perpendicular (crossing) lines from contour2 to contour1
     x_lines2 = []
-    for vertex in high_contour.vertices:
-        closest_point = vertex.closest_point(low_contour)
-        temp_line = ADPolyline(vertices=[closest_point, vertex])
-        x_lines2.append(temp_line)
-    x_lines2 = _remove_intersecting_lines(x_lines2, high_contour)
+    with instruments.stage(inst.CROSSING_LINES):
+        for vertex in high_contour.vertices:
+            closest_point = vertex.closest_point(low_contour)
+            temp_line = ADPolyline(vertices=[closest_point, vertex])
+            x_lines2.append(temp_line)
+    with instruments.stage(inst.REMOVE_INTERSECTING):
+        x_lines2 = _remove_intersecting_lines(x_lines2, high_contour)
     assert x_lines2 != []
 
     if DEBUG_X_LINES_1_N_2:
@@ -523,8 +673,20 @@ def draw_line_between_contours(low_contour, high_contour, last_pos, current_pos)
         for line in x_lines2:
             print low_contour.project(line.first_point)
 
+    if diagnostics.enabled:
+        diagnostics.add(diag.RAW_LINES, x_lines1 + x_lines2)
+
     # Combine both lists
-    crossing_lines = _sort_lines(x_lines1, x_lines2, low_contour, high_contour)
+    with instruments.stage(inst.FILTER):
+        crossing_lines = _sort_lines(x_lines1, x_lines2, low_contour, high_contour)
+
+    if instruments.enabled:
+        vertices = len(low_contour.coords) + len(high_contour.coords)
+        unfiltered = len(x_lines1) + len(x_lines2)
+        instruments.count(inst.VERTICES, vertices)
+        instruments.count(inst.LINES_GENERATED, vertices)
+        instruments.count(inst.LINES_INTERSECTING, vertices - unfiltered)
+        instruments.count(inst.LINES_FILTERED, unfiltered - len(crossing_lines))
 
     # Create last crossing line at BFE intercept on contour2
     temp_line = ADPolyline(vertices=[low_contour.last_point, high_contour.last_point])
@@ -548,70 +710,123 @@ def draw_line_between_contours(low_contour, high_contour, last_pos, current_pos)
 
     # Add distances along contour1 to crossing lines --------------------------------------
     # Lines should already be sorted
+    with instruments.stage(inst.CROSSING_LINES):
+        distance = np.array([low_contour.project(line.first_point) for line in crossing_lines])
+        lines = np.array([line.coords for line in crossing_lines])
     if DEBUG_x_line_dist:
-        print 'calcing crossing_lines distances for ', len(crossing_lines), 'lines'
-    total_distance = 0
-    for line in crossing_lines:
-        line.distance = low_contour.project(line.first_point)
-        if DEBUG_x_line_dist:
-            print 'line.distance = ', line.distance
-        # Hack, I only care about the distance at the last line
-        total_distance = line.distance
-    if DEBUG_x_line_dist:
-        print '     total_distance = ', total_distance
-        print 'normal distances:'
-    # assert _distance_always_increases(crossing_lines)
+        print 'crossing_lines distances:', distance
 
-    # Normalize distance based on position
-    m = (current_pos - last_pos)/total_distance
-    b = last_pos
-    for line in crossing_lines:
-        line.normal_distance = m*line.distance + b
-        if DEBUG_x_line_dist:
-            print 'normal distance = ', line.normal_distance
-
-    # Correct first and last lines for rounding issues
-    # assert round(crossing_lines[0], 1) == 0.0
-    # assert round(crossing_lines[-1], 1) == 1.0
-    crossing_lines[0].normal_distance = last_pos
-    crossing_lines[-1].normal_distance = current_pos
-
-    # Iteratively recalculate distances based on interpolated line -----------------------------
-    # The number of iterations should be an option or based on some error check, this is slow however
-    for i in range(3):
-        # Create test points
-        for line in crossing_lines:
-            line.test_point = line.point_at_distance(line.normal_distance, normalize=True)
-
-        # recalculate distances based on test points
-        total_distance = 0
-        last_point = crossing_lines[0].test_point
-        for line in crossing_lines[1:]:
-            temp_dist = last_point.distance_to(line.test_point)
-            total_distance += temp_dist
-            line.distance = total_distance
-            last_point = line.test_point
-        m = (current_pos - last_pos)/total_distance
-        b = last_pos
-        for line in crossing_lines:
-            line.normal_distance = m*line.distance + b
-
-        crossing_lines[0].normal_distance = last_pos
-        crossing_lines[-1].normal_distance = current_pos
-
-    if DEBUG_draw_xlines_B:
-        for i, line in enumerate(crossing_lines):
-            pyplot.plot(line.shapely_geo.xy[0], line.shapely_geo.xy[1], color='orange', linewidth=1, marker='^')
-            midpoint = line.mid_point()
-            midpoint.label(text=i)
+    if diagnostics.enabled:
+        diagnostics.add(diag.CROSSING_LINES, lines)
+    return CrossingLineFan(lines, distance)
 
-    # Interpolate line --------------------------------------------------------------
-    interpolated_points = []
-    for line in crossing_lines:
-        new_point = line.point_at_distance(line.normal_distance, normalize=True)
-        interpolated_points.append(new_point)
 
-    return ADPolyline(vertices=interpolated_points)
+class CrossingLineFan(object):
+    """
+    Crossing lines between a pair of clipped contours and the distance of each along the low contour. Only the
+    boundary position depends on the water surface, so one fan can be used for any number of profiles that share the
+    contours and clip window.
+    """
+    def __init__(self, lines, distance):
+        """
+        :param lines: (N, 2, 2) array of crossing lines, low contour end first, sorted upstream
+        :param distance: (N,) array - distance along low contour to the first point of each line
+        """
+        self.lines = lines
+        self.distance = distance
+
+    def boundary(self, last_pos, current_pos, diagnostics=None, instruments=None):
+        """
+        Interpolates boundary across the crossing lines from last_pos to current_pos
+        :param last_pos: float - position to begin at (first vertex) between high and low contour, 0.0 to 1.0
+        :param current_pos: float - position to end at (last vertex) between high and low contour
+        :param diagnostics: diagnostics sink, defaults to DIAGNOSTICS
+        :param instruments: stage timers and counters, defaults to INSTRUMENTS
+        :return: ADPolyline with the number of refinement passes in .iterations, and .converged False if refinement
+                 stopped at the pass limit while positions were still moving
+        """
+        if diagnostics is None:
+            diagnostics = DIAGNOSTICS
+        if instruments is None:
+            instruments = INSTRUMENTS
+
+        with instruments.stage(inst.REFINEMENT):
+            # Normalize distance based on position, first and last lines set exactly for rounding issues
+            if self.distance[-1] == 0:
+                raise ZeroDivisionError('Crossing lines are all at the same place on the low contour')
+            normal_distance = (current_pos - last_pos) / self.distance[-1] * self.distance + last_pos
+            normal_distance[0] = last_pos
+            normal_distance[-1] = current_pos
+
+            # Iteratively recalculate distances based on interpolated line
+            normal_distance, iterations, converged = refine_positions(self.lines, normal_distance, last_pos,
+                                                                      current_pos, diagnostics=diagnostics)
+
+        # Interpolate line
+        with instruments.stage(inst.INTERPOLATION):
+            t = np.clip(normal_distance, 0.0, 1.0)[:, np.newaxis]
+            interpolated_points = self.lines[:, 0] + t * (self.lines[:, 1] - self.lines[:, 0])
+
+        if instruments.enabled:
+            instruments.count(inst.LINES_KEPT, len(self.lines))
+            instruments.count(inst.REFINE_ITERATIONS, iterations)
+            if not converged:
+                instruments.count(inst.REFINE_NOT_CONVERGED)
+
+        boundary = ADPolyline(coords=interpolated_points)
+        boundary.iterations = iterations
+        boundary.converged = converged
+        if diagnostics.enabled:
+            diagnostics.add(diag.BOUNDARY, interpolated_points)
+        return boundary
+
+
+def refine_positions(lines, normal_distance, last_pos, current_pos, tolerance=None, max_iterations=None,
+                     diagnostics=None):
+    """
+    Iteratively recalculates the normalized position of the boundary along each crossing line. Each pass places a test
+    point on every line, measures distance along the test points and rescales it to run from last_pos to current_pos.
+    Stops when the largest change in position is below tolerance or after max_iterations passes.
+    :param lines: (N, 2, 2) array of crossing lines, low contour end first
+    :param normal_distance: (N,) array - starting positions along the lines, 0.0 to 1.0
+    :param last_pos: float - position at first line
+    :param current_pos: float - position at last line
+    :param tolerance: float - defaults to REFINE_TOLERANCE
+    :param max_iterations: int - defaults to REFINE_MAX_ITERATIONS
+    :param diagnostics: diagnostics sink, defaults to DIAGNOSTICS
+    :return: (N,) array of positions, number of passes run, True if the last change was below tolerance
+    """
+    if tolerance is None:
+        tolerance = REFINE_TOLERANCE
+    if max_iterations is None:
+        max_iterations = REFINE_MAX_ITERATIONS
+    if diagnostics is None:
+        diagnostics = DIAGNOSTICS
+    start = lines[:, 0]
+    delta = lines[:, 1] - lines[:, 0]
+    iterations = 0
+    converged = False
+    while iterations < max_iterations:
+        test_points = start + np.clip(normal_distance, 0.0, 1.0)[:, np.newaxis] * delta
+        if diagnostics.enabled:
+            diagnostics.add(diag.REFINEMENT, test_points)
+        distance = np.zeros(len(test_points))
+        distance[1:] = np.cumsum(np.hypot(*np.diff(test_points, axis=0).T))
+        if distance[-1] == 0:
+            raise ZeroDivisionError('Boundary has zero length')
+        new_distance = (current_pos - last_pos) / distance[-1] * distance + last_pos
+        if not np.isfinite(new_distance).all():
+            # Near zero length the division overflows
+            raise ZeroDivisionError('Boundary positions are not finite')
+        new_distance[0] = last_pos
+        new_distance[-1] = current_pos
+        iterations += 1
+        change = np.abs(new_distance - normal_distance).max()
+        normal_distance = new_distance
+        if change < tolerance:
+            converged = True
+            break
+    return normal_distance, iterations, converged
 
 
 def _fix_zig_zags(crossing_lines, contour, point):
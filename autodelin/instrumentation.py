@@ -0,0 +1,170 @@
+"""
+Stage timers and counters for delineation. The default NullInstruments does nothing. Instruments records wall time
+per stage and counts (vertices, crossing lines, shapely calls) and reports them for the run. Counts from SMP workers
+are sent back with each boundary and added in the main process.
+
+Usage:
+    import autodelin.geo_tools as gt
+    import autodelin.instrumentation as inst
+    gt.set_instruments(inst.Instruments())
+    ... delineate ...
+    print gt.INSTRUMENTS.report()
+    gt.INSTRUMENTS.save('run.json')
+"""
+import json
+import time
+
+# Stages
+PREPARE = 'prepare'
+CLIP = 'clip'
+CROSSING_LINES = 'crossing_lines'
+REMOVE_INTERSECTING = 'remove_intersecting_lines'
+FILTER = 'filter_crossing_lines'
+REFINEMENT = 'refinement'
+INTERPOLATION = 'interpolation'
+SEGMENT = 'segment'
+
+# Counts
+SEGMENTS = 'segments'
+SEGMENTS_CACHED = 'segments_cached'
+FANS_REUSED = 'crossing_line_fans_reused'
+VERTICES = 'contour_vertices'
+LINES_GENERATED = 'crossing_lines_generated'
+LINES_INTERSECTING = 'crossing_lines_intersecting'
+LINES_FILTERED = 'crossing_lines_filtered'
+LINES_KEPT = 'crossing_lines_kept'
+REFINE_ITERATIONS = 'refinement_iterations'
+REFINE_NOT_CONVERGED = 'refinement_not_converged'
+# Shapely operations while clipping and running segments, counted where they're called, see geo_tools.shapely_calls()
+SHAPELY_CALLS = 'shapely_calls'
+
+
+class _NullStage(object):
+    """ Context manager that does nothing """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class NullInstruments(object):
+    """
+    Default instruments, ignores everything. stage() returns a shared do-nothing context manager so disabled
+    instruments cost a method call per stage.
+    """
+    enabled = False
+
+    def stage(self, name):
+        """
+        Times the body of a with statement
+        :param name: string - one of the stage constants in this module
+        """
+        return _NULL_STAGE
+
+    def count(self, name, n=1):
+        """
+        Adds n to count name
+        :param name: string - one of the count constants in this module
+        :param n: int
+        """
+        pass
+
+
+class Instruments(NullInstruments):
+    """
+    Records time and number of calls per stage and counts. Pickles empty, so copies sent to SMP workers don't carry
+    the main process totals.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+
+    def __getstate__(self):
+        return {'times': {}, 'calls': {}, 'counts': {}}
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        """
+        Adds time to stage name
+        :param name: string - stage
+        :param seconds: float
+        """
+        self.times[name] = self.times.get(name, 0.) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def snapshot(self):
+        """
+        Returns recorded times and counts
+        :return: dict
+        """
+        return {'times': dict(self.times), 'calls': dict(self.calls), 'counts': dict(self.counts)}
+
+    def merge(self, snapshot):
+        """
+        Adds times and counts from snapshot(), e.g. from an SMP worker
+        :param snapshot: dict
+        """
+        for name, seconds in snapshot['times'].items():
+            self.times[name] = self.times.get(name, 0.) + seconds
+        for name, calls in snapshot['calls'].items():
+            self.calls[name] = self.calls.get(name, 0) + calls
+        for name, n in snapshot['counts'].items():
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def reset(self):
+        """ Clears times and counts """
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+
+    def report(self):
+        """
+        Returns times and counts as a table. Stage times from SMP workers are summed across workers, so they can add
+        up to more than the wall time of the run.
+        :return: string
+        """
+        lines = ['%-28s %10s %8s %12s' % ('stage', 'seconds', 'calls', 'ms/call')]
+        for name in sorted(self.times, key=lambda x: -self.times[x]):
+            calls = self.calls[name]
+            lines.append('%-28s %10.3f %8d %12.3f' % (name, self.times[name], calls,
+                                                       1000. * self.times[name] / calls))
+        lines.append('')
+        lines.append('%-28s %10s' % ('count', 'total'))
+        for name in sorted(self.counts):
+            lines.append('%-28s %10d' % (name, self.counts[name]))
+        return '\n'.join(lines)
+
+    def save(self, file_name):
+        """
+        Writes snapshot() to JSON file
+        :param file_name: string
+        """
+        with open(file_name, 'w') as out_file:
+            json.dump(self.snapshot(), out_file, indent=2, sort_keys=True)
+
+
+class _Stage(object):
+    """ Context manager that adds elapsed time to a stage """
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instruments.add_time(self.name, time.time() - self.start)
+        return False
@@ -1,14 +1,40 @@
+import math
+import numpy as np
 import logic
 import geo_tools as gt
-import fiona
-from shapely.geometry import shape, MultiLineString, LineString, MultiPoint, Point, mapping
-from matplotlib import pyplot
-import pathos.multiprocessing as mp
+import vector_tools as vt
+import contour_store as cs
+from segment_cache import SegmentCache
+from shapely.geometry import shape, MultiLineString, LineString, Point, mapping, box
+from shapely.strtree import STRtree
+from shapely.prepared import prep
+from collections import OrderedDict, deque
+import threading
+from lazy_import import LazyModule
+
+fiona = LazyModule('fiona')
+pyplot = LazyModule('matplotlib.pyplot')
+mp = LazyModule('pathos.multiprocessing')
 
 
 class ShapefileError (Exception):
     pass
 
+# Attributes written by Manager.export_stream()
+STREAM_SCHEMA = {'geometry': 'LineString',
+                 'properties': {'status': 'str:25',
+                                'reach': 'str:50',
+                                'side': 'str:5',
+                                'from': 'str:30',
+                                'to': 'str:30',
+                                'from_elev': 'float',
+                                'to_elev': 'float',
+                                'iterations': 'int',
+                                'converged': 'int'}}
+
+# Pass as bbox or elevation_range to Manager.import_contours() to derive the window from the rivers and BFE/XS
+AUTO = 'auto'
+
 # Old style contours 2.18 GB, 1.36/segment
 # New: 500MB, 6.3 sec/segment, 5:48 total
 # Cache as needed 900MB 1.5/seg, 1:24 total
@@ -18,15 +44,65 @@ class ShapefileError (Exception):
 class Contours(object):
     """
     Holds a dictionary of fiona features (contours) by elevaiton. get() converts feature to Contour. Doing this on-
-    the-fly is less memory intensive and faster to load, but slower to delineate. Includes caching with cache aging
+    the-fly is less memory intensive and faster to load, but slower to delineate. Decoded contours are cached.
+
+    Contours can also come from a contour_store.ContourStore (add_store()). Those are decoded as views of the memory
+    mapped coordinates without copying.
+
+    Two cache policies are available:
+        age (default) - contours are aged each time a new contour is decoded and kicked from the cache after
+                        cache_age decodes, whether or not they were used meanwhile. Cache hits don't age or kick
+                        anything, so stale contours stay cached until the next decode
+        LRU - used if cache_bytes is set. Keeps the decoded size of the cache under cache_bytes by kicking the least
+              recently used contours. Contours passed to pin() are never kicked.
+    stats() reports hits, misses, evictions and resident bytes for either policy.
+
+    prefetch() decodes upcoming contours on a background thread. Prefetched contours are held until get() asks for
+    them, then cached as usual.
     """
-    def __init__(self, cache_age=4):
-        # dictionary of either Contour or fiona feature objects keyed by elevation
+    def __init__(self, cache_age=4, cache_bytes=None):
+        """
+        :param cache_age: int - age policy, number of decodes a contour stays cached before it's kicked
+        :param cache_bytes: int - LRU policy, maximum decoded size of the cache in bytes. None uses the age policy
+        """
+        # dictionary of fiona feature objects or store feature numbers (int) keyed by elevation
         self.contours = {}
-        # dictionary of CacheTrackers keyed by elevation
+        # ContourStore, set by add_store()
+        self.store = None
+        # Only store parts overlapping this (minx, miny, maxx, maxy) are decoded, None for all parts
+        self.bbox = None
+        # dictionary of decoded Contours keyed by elevation, in least to most recently used order
+        self.cache = OrderedDict()
+        # dictionary of CacheTrackers keyed by elevation, age policy only
         self.tracker = {}
-        # Number of self.get()'s that can run w/o accessing the contour before it's kicked from cache
+        # Number of decodes by self.get() a contour stays cached for before it's kicked, hits don't count
         self.cache_age = cache_age
+        # Maximum decoded size of cache, None for age policy
+        self.cache_bytes = cache_bytes
+        # Elevations that won't be kicked from the cache, LRU policy only
+        self.pinned = set()
+
+        # Decoded contours waiting for get(), keyed by elevation
+        self.prefetched = {}
+        # Elevations for the prefetch thread to decode, in order, and all elevations in the current prefetch request
+        self._prefetch_queue = deque()
+        self._wanted = set()
+        # Elevation the prefetch thread is decoding, None if idle
+        self._decoding = None
+        # Guards the cache and prefetch attributes, the prefetch thread is started by prefetch() and stopped by close()
+        self._condition = threading.Condition()
+        self._prefetch_thread = None
+        self._stopping = False
+
+        # Cache statistics
+        self.hits = 0
+        self.prefetch_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resident_bytes = 0
+        self.peak_bytes = 0
+        # Size of each cached contour when it was added, subtracted as is when it's kicked
+        self._sizes = {}
 
     def get(self, elevation):
         """
@@ -34,64 +110,221 @@ class Contours(object):
         :param elevation: int
         :return: Contour object
         """
-        temp_geo = self.contours[elevation]
+        with self._condition:
+            # Don't decode twice if the prefetch thread is already on it
+            while self._decoding == elevation:
+                self._condition.wait()
+
+            # Check if cached
+            if elevation in self.cache:
+                self.hits += 1
+                temp_contour = self.cache.pop(elevation)
+                self.cache[elevation] = temp_contour
+                return temp_contour
+
+            if elevation in self.prefetched:
+                self.prefetch_hits += 1
+                temp_contour = self.prefetched.pop(elevation)
+            else:
+                temp_geo = self.contours[elevation]
+                self.misses += 1
+                temp_contour = self._decode(temp_geo, elevation)
+            self._cache_new(elevation, temp_contour)
+            return temp_contour
+
+    def prefetch(self, elevations):
+        """
+        Decodes contours at elevations on a background thread. Replaces any previous prefetch request, prefetched
+        contours not in elevations are dropped.
+        :param elevations: list of elevations, in the order they will be needed
+        """
+        with self._condition:
+            self._prefetch_queue = deque(x for x in elevations if x in self.contours)
+            self._wanted = set(elevations)
+            for elev in self.prefetched.keys():
+                if elev not in self._wanted:
+                    self.prefetched.pop(elev)
+            if self._prefetch_thread is None:
+                self._prefetch_thread = threading.Thread(target=self._prefetch_worker, name='contour-prefetch')
+                self._prefetch_thread.daemon = True
+                self._prefetch_thread.start()
+            self._condition.notify_all()
+
+    def close(self):
+        """
+        Stops the prefetch thread and drops prefetched contours. The thread holds on to this object, it isn't freed
+        until close() is called. Safe to call more than once, prefetch() starts a new thread if needed
+        """
+        with self._condition:
+            thread = self._prefetch_thread
+            if thread is None:
+                return
+            self._stopping = True
+            self._prefetch_queue = deque()
+            self._wanted = set()
+            self.prefetched = {}
+            self._condition.notify_all()
+        thread.join()
+        with self._condition:
+            self._prefetch_thread = None
+            self._stopping = False
 
-        # Check if cached
-        if type(temp_geo) is Contour:
-            return temp_geo
+    def add(self, geo, elev):
+        """ adds fiona geometry to contour list"""
+        self.contours.update({elev: geo})
 
-        # Age cache and create tracker
-        self._age_cache()
-        tracker = CacheTracker(age=self.cache_age, geo=temp_geo)
-        self.tracker.update({elevation: tracker})
+    def add_store(self, store, bbox=None, elevation_range=None):
+        """
+        adds contours in store to contour list
+        :param store: contour_store.ContourStore
+        :param bbox: (minx, miny, maxx, maxy) - only parts overlapping bbox are decoded, None for all parts
+        :param elevation_range: (min, max) - only add contours in this range (inclusive), None for all
+        """
+        self.store = store
+        self.bbox = bbox
+        elevations = store.elevations.tolist()
+        for feature in store.features_in_range(elevation_range):
+            if bbox is not None and not cs.bounds_overlap(store.bounds[slice(*store.feature_parts[feature])],
+                                                          bbox).any():
+                continue
+            self.contours.update({elevations[feature]: feature})
+
+    def length(self):
+        return len(self.contours)
 
-        # Force to list
-        temp_geo = shape(temp_geo)
-        if type(temp_geo) is MultiLineString:
-            geos = list(temp_geo)
-        elif type(temp_geo) is LineString:
-            geos = list(MultiLineString([temp_geo]))
+    def pin(self, elevations):
+        """
+        Keeps contours at elevations in the cache (LRU policy). Replaces previously pinned elevations
+        :param elevations: list of elevations, empty list to unpin everything
+        """
+        self.pinned = set(elevations)
+
+    def stats(self):
+        """
+        Returns cache statistics
+        :return: dict
+        """
+        return {'policy': 'age' if self.cache_bytes is None else 'lru',
+                'hits': self.hits,
+                'prefetch_hits': self.prefetch_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'cached_contours': len(self.cache),
+                'resident_bytes': self.resident_bytes,
+                'peak_bytes': self.peak_bytes}
+
+    def _decode(self, temp_geo, elevation):
+        """
+        Converts fiona geometry or store feature number to Contour
+        :param temp_geo: fiona geometry or int
+        :param elevation: contour elevation
+        :return: Contour object
+        """
+        # Force to list, coordinates are read straight from the fiona geometry or store without building shapely
+        # objects
+        if type(temp_geo) is int:
+            parts = self.store.parts(temp_geo, self.bbox)
+        elif temp_geo['type'] == 'MultiLineString':
+            parts = temp_geo['coordinates']
+        elif temp_geo['type'] == 'LineString':
+            parts = [temp_geo['coordinates']]
         else:
             raise ShapefileError('Contour file does not appear to contain lines.')
 
         # Convert to ADPolylines
         lines = []
-        for geo in geos:
-            temp_poly = gt.ADPolyline(shapely_geo=geo)
+        for part in parts:
+            temp_poly = gt.ADPolyline(coords=part)
             lines.append(temp_poly)
 
-        # Make a contour and cache it
+        # Make a contour and index it
         temp_contour = Contour(lines, elevation)
-        self.contours[elevation] = temp_contour
-
+        temp_contour.build_index()
         return temp_contour
 
-    def add(self, geo, elev):
-        """ adds fiona geometry to contour list"""
-        self.contours.update({elev: geo})
-
-    def length(self):
-        return len(self.contours)
+    def _cache_new(self, elevation, contour):
+        """ Caches newly decoded contour and applies cache policy """
+        if self.cache_bytes is None:
+            # Age cache and create tracker
+            self._age_cache()
+            self.tracker.update({elevation: CacheTracker(age=self.cache_age)})
+        self._add_to_cache(elevation, contour)
+        if self.cache_bytes is not None:
+            self._trim_cache(keep=elevation)
+
+    def _prefetch_worker(self):
+        """ Prefetch thread, decodes contours from self._prefetch_queue into self.prefetched until close() """
+        while True:
+            with self._condition:
+                while not self._prefetch_queue and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                elevation = self._prefetch_queue.popleft()
+                if elevation in self.cache or elevation in self.prefetched:
+                    continue
+                self._decoding = elevation
+                temp_geo = self.contours[elevation]
+
+            # Decode without the lock so get() can serve cached contours meanwhile
+            try:
+                temp_contour = self._decode(temp_geo, elevation)
+            except Exception:
+                # get() decodes it again and raises the error in the main thread
+                temp_contour = None
+
+            with self._condition:
+                self._decoding = None
+                if temp_contour is not None and elevation in self._wanted:
+                    self.prefetched[elevation] = temp_contour
+                self._condition.notify_all()
+
+    def _add_to_cache(self, elevation, contour):
+        self.cache[elevation] = contour
+        self._sizes[elevation] = contour.nbytes
+        self.resident_bytes += self._sizes[elevation]
+        self.peak_bytes = max(self.peak_bytes, self.resident_bytes)
+
+    def _remove_from_cache(self, elevation):
+        contour = self.cache.pop(elevation)
+        self.tracker.pop(elevation, None)
+        self.resident_bytes -= self._sizes.pop(elevation)
+        self.evictions += 1
 
     def _age_cache(self):
-        """ Ages all cached contours. Kicks old contours out of cache and restores fiona geo to contour list. """
+        """ Ages all cached contours. Kicks old contours out of cache. """
         for elev, contour in self.tracker.items():
             if contour.age == 0:
-                # Remove from cache, reset fiona geo in contours
-                self.contours[elev] = contour.geo
-                self.tracker.pop(elev)
+                # Remove from cache
+                self._remove_from_cache(elev)
             contour.age -= 1
 
+    def _trim_cache(self, keep):
+        """
+        Kicks least recently used, unpinned contours out of cache until it fits in self.cache_bytes
+        :param keep: elevation of contour that was just added, never kicked
+        """
+        for elev in list(self.cache.keys()):
+            if self.resident_bytes <= self.cache_bytes:
+                break
+            if elev == keep or elev in self.pinned:
+                continue
+            self._remove_from_cache(elev)
+
 
 class CacheTracker(object):
-    """ Holds fiona geo and age of cached contour for Contours class"""
-    def __init__(self, age=None, geo=None):
-        """ Age and geo should NEVER be none. I'm being lazy by not checking values. """
+    """ Holds age of cached contour for Contours class"""
+    def __init__(self, age=None):
+        """ Age should NEVER be none. I'm being lazy by not checking values. """
         self.age = age
-        self.geo = geo
 
 
 class Contour(object):
+    """
+    Dissolved contour, one or more ADPolylines (parts) at the same elevation. Multipart contours have a spatial index
+    over their parts for nearest part lookups. The index lives with the Contour, so it is dropped when Contours
+    kicks the contour out of the cache.
+    """
     def __init__(self, line_list, elevation):
         """
         :param line_list: list of ADPolyline objects representing a dissolved contour
@@ -99,12 +332,72 @@ class Contour(object):
         """
         self.line_list = line_list
         self.elevation = elevation
+        # STRtree of part geometries, part index by id() of geometry and starting search radius, set by build_index()
+        self._index = None
+        self._part_index = None
+        self._search_radius = None
 
         if len(line_list) == 1:
             self.multipart = False
         else:
             self.multipart = True
 
+    @property
+    def nbytes(self):
+        """
+        Approximate decoded size in bytes: vertex arrays, twice over for indexed multipart contours (the index holds
+        shapely copies of the parts). Shapely geometries and station tables built later on demand aren't counted.
+        """
+        size = sum(line.coords.nbytes for line in self.line_list)
+        if self._index is not None:
+            size *= 2
+        return size
+
+    def build_index(self):
+        """ Builds spatial index over parts. Does nothing for single part contours """
+        if not self.multipart or self._index is not None:
+            return
+        geos = [line.shapely_geo for line in self.line_list]
+        self._part_index = dict((id(geo), i) for i, geo in enumerate(geos))
+        self._index = STRtree(geos)
+        # Half the average part size, most points we look for are on or near a part
+        sizes = [max(maxx - minx, maxy - miny) for minx, miny, maxx, maxy in (geo.bounds for geo in geos)]
+        self._search_radius = max(sum(sizes) / len(sizes) / 2.0, 1.0)
+
+    def closest_part(self, point):
+        """
+        Returns index of part in self.line_list that is closest to point. Ties go to the lowest index
+        :param point: ADPoint
+        :return: int
+        """
+        if not self.multipart:
+            return 0
+        self.build_index()
+        geo = point.shapely_geo
+
+        # Grow search window until it reaches a part. STRtree.nearest() isn't used, it checks every part
+        radius = self._search_radius
+        candidates = self._index.query(self._window(point, radius))
+        calls = 1
+        while not candidates:
+            radius *= 2
+            candidates = self._index.query(self._window(point, radius))
+            calls += 1
+
+        # The closest part is no farther than the closest candidate, check everything within that distance
+        dist = min(part.distance(geo) for part in candidates)
+        calls += len(candidates) + 1
+        candidates = self._index.query(self._window(point, dist))
+        gt.count_shapely_calls(calls + len(candidates))
+        return min((part.distance(geo), self._part_index[id(part)]) for part in candidates)[1]
+
+    @staticmethod
+    def _window(point, radius):
+        """ Returns square around point for index queries """
+        if radius == 0:
+            return point.shapely_geo
+        return box(point.X - radius, point.Y - radius, point.X + radius, point.Y + radius)
+
     def plot(self, *args, **kwargs):
         for line in self.line_list:
             line.plot(*args, **kwargs)
@@ -133,6 +426,19 @@ class CrossSection(object):
         self.elevation = None
         self.station = None
         self.river_intersect = None
+        # Extents and elevation of every imported profile, by profile name. See set_profile()
+        self.profiles = {}
+
+    def set_profile(self, profile):
+        """
+        Copies extents and elevation of profile to self.left_extent, self.right_extent and self.elevation, which are
+        used for delineation. They are set to None if profile wasn't imported for this cross section
+        :param profile: string - profile name
+        """
+        extents = self.profiles.get(profile, ProfileExtents())
+        self.left_extent = extents.left_extent
+        self.right_extent = extents.right_extent
+        self.elevation = extents.elevation
 
     def plot(self, *args, **kwargs):
         X = self.geo.first_point.X
@@ -147,6 +453,16 @@ class CrossSection(object):
         return str(self)
 
 
+class ProfileExtents(object):
+    """
+    Water surface elevation and extents of one profile at a cross section
+    """
+    def __init__(self):
+        self.elevation = None
+        self.left_extent = None
+        self.right_extent = None
+
+
 class River(object):
     """
     Holds river geometry and name of HEC-RAS river and reach for a single reach.
@@ -160,6 +476,16 @@ class River(object):
         self.geo = geo
         self.river = river
         self.reach = reach
+        # BFE/XS that cross the reach, in full_combo_list order. Set by join_features(), None if not joined yet
+        self.features = None
+        self._reference = None
+
+    @property
+    def reference(self):
+        """ vector_tools.LinearReference for stationing along the reach, built on first use """
+        if self._reference is None:
+            self._reference = vt.LinearReference(self.geo.coords)
+        return self._reference
 
     def matches(self, river, reach):
         if self.river == river and self.reach == reach:
@@ -171,6 +497,16 @@ class River(object):
 class Rivers(object):
     def __init__(self):
         self.reaches = []
+        # River objects by (river, reach), first reach wins for duplicate names
+        self._by_name = {}
+
+    def add(self, river):
+        """
+        Adds reach
+        :param river: River object
+        """
+        self.reaches.append(river)
+        self._by_name.setdefault((river.river, river.reach), river)
 
     def get_reach(self, river, reach):
         """
@@ -179,10 +515,169 @@ class Rivers(object):
         :param reach: string - name of RAS reach
         :return: River object if success, else None
         """
-        for test_river in self.reaches:
-            if test_river.matches(river, reach):
-                return test_river
-                
+        return self._by_name.get((river, reach))
+
+
+def _is_auto(window):
+    """ Returns True if window is AUTO. Windows can be arrays, so == can't be used on its own """
+    return isinstance(window, basestring) and window == AUTO
+
+
+def _parts_in_bbox(geo, bbox):
+    """
+    Drops parts of a fiona line geometry that don't overlap bbox
+    :param geo: fiona LineString or MultiLineString geometry
+    :param bbox: (minx, miny, maxx, maxy)
+    :return: fiona MultiLineString geometry with parts as (N, 2) arrays, None if no parts overlap
+    """
+    if geo['type'] == 'MultiLineString':
+        parts = geo['coordinates']
+    elif geo['type'] == 'LineString':
+        parts = [geo['coordinates']]
+    else:
+        raise ShapefileError('Contour file does not appear to contain lines.')
+    parts = [np.array(part, dtype=float)[:, :2] for part in parts]
+    bounds = np.array([np.concatenate((part.min(axis=0), part.max(axis=0))) for part in parts]).reshape(-1, 4)
+    kept = [part for part, keep in zip(parts, cs.bounds_overlap(bounds, bbox).tolist()) if keep]
+    if not kept:
+        return None
+    return {'type': 'MultiLineString', 'coordinates': kept}
+
+
+def join_features(reaches, full_combo_list):
+    """
+    Finds the BFE/XS that cross each reach and stores them in River.features. BFE/XS envelopes go in an STRtree so
+    each reach only tests the features near it, with a prepared reach geometry.
+    :param reaches: list of River objects
+    :param full_combo_list: list of logic.BFE and CrossSection objects
+    """
+    if not full_combo_list:
+        for river in reaches:
+            river.features = []
+        return
+    geos = [item.geo.shapely_geo for item in full_combo_list]
+    index = dict((id(geo), i) for i, geo in enumerate(geos))
+    tree = STRtree(geos)
+    for river in reaches:
+        reach_geo = river.geo.shapely_geo
+        prepared = prep(reach_geo)
+        found = sorted(index[id(geo)] for geo in tree.query(reach_geo) if prepared.crosses(geo))
+        river.features = [full_combo_list[i] for i in found]
+
+
+class ReachJob(object):
+    """
+    BFE/XS for one river/reach, selected and sorted by station along the river. Stations are kept with the job instead
+    of on the BFE/XS so reaches that share a BFE/XS can be delineated together.
+    """
+    def __init__(self, river, full_combo_list, start=None, end=None):
+        """
+        :param river: River object
+        :param full_combo_list: list of all logic.BFE and CrossSection objects
+        :param start: lowest elevation bfe/cross section to use, None for all
+        :param end: highest elevation bfe to use, None for all
+        """
+        self.river = river
+        combo_list = self.select_bfe_xs(river, full_combo_list)
+        stations = self.calc_stations(river, combo_list)
+        # Sort by station
+        order = sorted(range(len(combo_list)), key=lambda i: stations[i][1])
+        self.combo_list = [combo_list[i] for i in order]
+        self.stations = [stations[i][1] for i in order]
+        if start is not None or end is not None:
+            self.combo_list = trim_bfe_xs(self.combo_list, start, end)
+
+    @property
+    def name(self):
+        return self.river.river, self.river.reach
+
+    @property
+    def cost(self):
+        """ Estimated cost of delineating reach, number of BFE/XS """
+        return len(self.combo_list)
+
+    @staticmethod
+    def select_bfe_xs(river, full_combo_list):
+        """
+        Returns BFE/XS from full_combo_list that cross river. Cross sections without extents are skipped. If
+        river.features is set (join_features()) it is used instead of testing every item in full_combo_list
+        :param river: River object
+        :param full_combo_list: list of logic.BFE and CrossSection objects
+        :return: list of logic.BFE and CrossSection objects
+        """
+        if river.features is not None:
+            candidates = river.features
+        else:
+            candidates = [item for item in full_combo_list if item.geo.crosses(river.geo)]
+        combo_list = []
+        for item in candidates:
+            if type(item) is logic.BFE:
+                combo_list.append(item)
+            else:
+                # Only include cross sections with extents
+                if item.left_extent is not None and item.right_extent is not None:
+                    combo_list.append(item)
+        return combo_list
+
+    @staticmethod
+    def calc_stations(river, combo_list):
+        """
+        Calculates stations for BFEs/XSs in combo_list
+        :param river: River object
+        :param combo_list: list of logic.BFE and CrossSection objects
+        :return: list of (ADPoint, float) - river intersection and station for each item in combo_list
+        """
+        crossings = river.reference.intersect([item.geo.coords for item in combo_list])
+        multiple = [str(item.name) for item, (x, _) in zip(combo_list, crossings) if len(x) > 1]
+        if multiple:
+            raise ShapefileError('BFE/XS ' + ', '.join(multiple) + ' cross channel alignment multiple times.')
+        missing = [str(item.name) for item, (x, _) in zip(combo_list, crossings) if len(x) == 0]
+        if missing:
+            raise ShapefileError('BFE/XS ' + ', '.join(missing) + ' do not cross channel alignment. Does ' +
+                                 'select_xs_bfe() need to be run?')
+        stations = []
+        for station, point in crossings:
+            x, y = point[0].tolist()
+            stations.append((gt.ADPoint(x, y), float(station[0])))
+        return stations
+
+    def __str__(self):
+        return str(self.river.river) + '/' + str(self.river.reach)
+
+
+def trim_bfe_xs(combo_list, start=None, end=None):
+    """
+    Returns BFE/cross sections in combo_list that are between start and end, in upstream order
+    :param combo_list: list of logic.BFE and CrossSection objects, sorted by station
+    :param start: lowest elevation bfe/cross section to use
+    :param end: highest elevation bfe to use
+    :return: list of logic.BFE and CrossSection objects
+    """
+    # Check for proper order
+    if combo_list[0].elevation > combo_list[-1].elevation:
+        # print 'BFE/cross section list appears to be in reverse order. Reversing.'
+        combo_list = combo_list[::-1]
+
+    # if start > end:
+    #     end, start = start, end
+
+    new_bfe_xs_list = []
+    flag = 'out'
+    for bfe_xs in combo_list:
+        if bfe_xs.name == start:
+            flag = 'in'
+            new_bfe_xs_list.append(bfe_xs)
+        elif flag == 'in' and bfe_xs.name != end:
+            new_bfe_xs_list.append(bfe_xs)
+        elif bfe_xs.name == end:
+            new_bfe_xs_list.append(bfe_xs)
+            break
+            # print 'bfe_xs.name=', bfe_xs.name,'start=', start,'end=', end
+    if len(new_bfe_xs_list) < 2:
+        raise ValueError('combo_list has less than two elements.' +
+                         ' start and end appear invalid. Are they switched?.')
+    return new_bfe_xs_list
+
 
 class Manager(object):
     """
@@ -205,8 +700,58 @@ class Manager(object):
         self.crs = None             # fiona.crs object, from contours
         self.combo_list = None      # partial list of CrossSection and logic.BFE objects for the current reach
         self.full_combo_list = []  # Full list of logic.BFE and CrossSection objects
+        self.xs_index = {}          # CrossSection objects by id, for matching extents
+        self.profile = None         # Name of profile used for delineation, see set_profile()
+        self._joined = False        # BFE/XS have been assigned to reaches, see join_features()
+        self.contour_buffer = 100.  # Distance around reaches and BFE/XS to import contours, see contour_window()
 
         self.workers = 0            # Number of works for SMP, 0 = no SMP
+        self.engine = gt.SHAPELY    # Crossing line engine, gt.SHAPELY or gt.NUMPY (faster)
+        self.cache_bytes = None     # Contour cache size in bytes (LRU), None to kick contours by age
+        self.concurrent = False     # Run left and right banks concurrently, requires workers
+        self.segment_cache = None   # Directory for segment result cache, None for no caching
+        # True starts the worker pool as soon as contours are imported so workers share the loaded contours
+        # copy-on-write. False starts it on the first run_*(). Ignored when workers is 0
+        self.fork_after_contours = False
+
+        self._pool = None           # Worker pool, created by start_workers(), closed by close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start_workers(self):
+        """
+        Starts worker pool with self.workers processes, if not already running. The pool is reused by every side and
+        reach until close(). Workers are forked when the pool starts, starting it after contours are imported lets
+        them share the contours copy-on-write. Does nothing if self.workers is 0.
+        """
+        if self._pool is not None or not self.workers:
+            return
+        self._pool = mp.ProcessingPool(nodes=self.workers, id='manager-' + str(id(self)))
+
+    def _set_segment_cache(self):
+        """ Points logic at self.segment_cache """
+        if self.segment_cache is None:
+            logic.set_segment_cache(None)
+        elif logic.SEGMENT_CACHE is None or logic.SEGMENT_CACHE.cache_dir != self.segment_cache:
+            logic.set_segment_cache(SegmentCache(self.segment_cache))
+
+    def close(self):
+        """
+        Shuts down worker pool and the contour prefetch thread. Safe to call more than once, start_workers() can start
+        a new pool
+        """
+        if self.contours is not None:
+            self.contours.close()
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool.clear()
+        self._pool = None
 
     def import_bfes(self, bfe_file, elev_field='Elevation'):
         """
@@ -225,53 +770,174 @@ class Manager(object):
                 temp_bfe = logic.BFE(temp_poly, elev)
                 self.full_combo_list.append(temp_bfe)
         #self.bfes.sort(key=lambda x: x.elevation, reverse=True)
+        self._clear_join()
 
-    def import_contours(self, contour_file, elev_field, chatty=False):
+    def import_contours(self, contour_file, elev_field, chatty=False, store=None, bbox=None, elevation_range=None):
         """
         Imports contours from contour file. Contours are assumed to be dissolved by elevation
+        If store is set the contours are converted to a contour store in that directory the first time (or when
+        contour_file changes) and loaded from the memory mapped store after that. This is much faster for large
+        contour files.
+        Contours outside elevation_range are skipped without reading their geometry, and contour parts that don't
+        overlap bbox are dropped (parts that overlap are kept whole). Use AUTO for either to derive it from the
+        rivers and BFE/XS, see contour_window(). BFE/XS, extents and rivers must be imported first for AUTO.
         :param contour_file: string - name of contour shapefile
         :param elev_field: string - attribute field with contour elevations
         :param chatty: boolean - True prints import updates to stdout
+        :param store: string - contour store directory, None to read contour_file directly
+        :param bbox: (minx, miny, maxx, maxy), AUTO, or None for all parts
+        :param elevation_range: (min, max) inclusive, AUTO, or None for all elevations
         :return: list of Contour objects
         """
-        self.contours = Contours()
+        bbox, elevation_range = self._resolve_window(bbox, elevation_range, chatty)
+        if store is not None:
+            if not cs.is_current(store, contour_file, elev_field):
+                if chatty:
+                    print 'Building contour store', store, 'from', contour_file
+                cs.build_store(contour_file, elev_field, store, chatty=chatty)
+            self.import_contour_store(store, bbox, elevation_range, chatty)
+            return
+
+        if self.contours is not None:
+            self.contours.close()
+        self.contours = Contours(cache_bytes=self.cache_bytes)
         with fiona.collection(contour_file, 'r') as input_file:
             # Grab coordinate reference system
             self.crs = input_file.crs
-            for feature in input_file:
+            if elevation_range is None:
+                features = iter(input_file)
+            else:
+                features = self._features_in_range(contour_file, input_file, elev_field, elevation_range)
+            for feature in features:
                 elev = feature['properties'][elev_field]
                 temp_geo = feature['geometry']
+                if bbox is not None:
+                    temp_geo = _parts_in_bbox(temp_geo, bbox)
+                    if temp_geo is None:
+                        continue
 
                 # Make a contour
                 self.contours.add(temp_geo, elev)
                 if chatty:
                     if self.contours.length() % 25 == 0:
                         print self.contours.length(), 'contours imported...'
+        if self.fork_after_contours and self.workers > 0:
+            self.start_workers()
 
-    def import_extents(self, ext_file, profile, id_field='XS_ID', profile_field='Profile', elev_field='Elevation',
+    @staticmethod
+    def _features_in_range(contour_file, input_file, elev_field, elevation_range):
+        """
+        Yields features of input_file with elevations in elevation_range. Elevations are read first without geometry,
+        then only matching features are read
+        """
+        low, high = elevation_range
+        with fiona.collection(contour_file, 'r', ignore_geometry=True) as attribute_file:
+            wanted = [fid for fid, feature in attribute_file.items() if low <= feature['properties'][elev_field] <= high]
+        for fid in wanted:
+            yield input_file[fid]
+
+    def import_contour_store(self, store_dir, bbox=None, elevation_range=None, chatty=False):
+        """
+        Imports contours from contour store created by contour_store.build_store() or import_contours(store=...)
+        :param store_dir: string - contour store directory
+        :param bbox: (minx, miny, maxx, maxy), AUTO, or None for all parts, see import_contours()
+        :param elevation_range: (min, max) inclusive, AUTO, or None for all elevations
+        :param chatty: boolean - True prints the window found for AUTO
+        """
+        bbox, elevation_range = self._resolve_window(bbox, elevation_range, chatty)
+        store = cs.ContourStore(store_dir)
+        if self.contours is not None:
+            self.contours.close()
+        self.contours = Contours(cache_bytes=self.cache_bytes)
+        self.contours.add_store(store, bbox, elevation_range)
+        self.crs = store.crs
+        if self.fork_after_contours and self.workers > 0:
+            self.start_workers()
+
+    def contour_window(self, river_reach_list=None, buffer=None):
+        """
+        Returns the area and elevations of contours needed for the reaches: bounds of the reaches and the BFE/XS that
+        cross them grown by buffer, and floor/ceil of the lowest/highest BFE/XS elevation of any imported profile.
+        :param river_reach_list: list of tuples: (river, reach), None for self.river or all reaches in self.rivers
+        :param buffer: float - distance to grow the bounds, defaults to self.contour_buffer
+        :return: (minx, miny, maxx, maxy), (min elevation, max elevation)
+        """
+        if buffer is None:
+            buffer = self.contour_buffer
+        if river_reach_list is not None:
+            reaches = [job.river for job in self._reach_jobs(river_reach_list)]
+        elif self.river is not None:
+            reaches = [self.river]
+        elif self.rivers is not None:
+            reaches = self.rivers.reaches
+        else:
+            raise ValueError('Rivers must be imported before the contour window can be found')
+        self._join_if_needed()
+
+        bounds = []
+        elevations = []
+        for river in reaches:
+            bounds.append(river.geo.shapely_geo.bounds)
+            for item in river.features:
+                bounds.append(item.geo.shapely_geo.bounds)
+                if type(item) is CrossSection:
+                    elevations.extend(x.elevation for x in item.profiles.values() if x.elevation is not None)
+                if item.elevation is not None:
+                    elevations.append(item.elevation)
+        if not elevations:
+            raise ValueError('No BFE/XS elevations found for the reaches. Import BFE/XS and extents first.')
+        bounds = np.array(bounds)
+        bbox = (bounds[:, 0].min() - buffer, bounds[:, 1].min() - buffer,
+                bounds[:, 2].max() + buffer, bounds[:, 3].max() + buffer)
+        return tuple(float(x) for x in bbox), (math.floor(min(elevations)), math.ceil(max(elevations)))
+
+    def _resolve_window(self, bbox, elevation_range, chatty=False):
+        """ Replaces AUTO with the window from contour_window(). bbox and elevation_range may be arrays """
+        if _is_auto(bbox) or _is_auto(elevation_range):
+            auto_bbox, auto_range = self.contour_window()
+            if _is_auto(bbox):
+                bbox = auto_bbox
+            if _is_auto(elevation_range):
+                elevation_range = auto_range
+            if chatty:
+                print 'Contour window:', bbox, 'elevations', elevation_range
+        return bbox, elevation_range
+
+    def import_extents(self, ext_file, profile=None, id_field='XS_ID', profile_field='Profile', elev_field='Elevation',
                        pos_field='Position'):
         """
-        Imports extents with 'profile' and appends them to appropriate cross_sections
+        Imports extents and elevations for one or more profiles in a single pass over ext_file and stores them by
+        profile on the matching cross sections, see CrossSection.profiles. Cross sections must be imported first.
+        If profile is a single name it is made the profile used for delineation, otherwise call set_profile().
         :param ext_file: string - extents shapefile name
-        :param profile: string - name of profile to import
+        :param profile: string - name of profile to import, list of strings for several profiles, None for all
         :param id_field: string - attribute field with XS id
         :param profile_field: string - attribute field with profile
         :param elev_field: string - attribute field with XS elevation
         :param pos_field: string - attribute field with extent position
+        :return: list of strings - names of profiles imported
         """
-        def get_xs(temp_id):
-            for temp_xs in self.full_combo_list:
-                if type(temp_xs) is CrossSection:
-                    if temp_xs.id == temp_id:
-                        return temp_xs
+        if profile is None:
+            wanted = None
+        elif isinstance(profile, basestring):
+            wanted = {profile}
+        else:
+            wanted = set(profile)
 
+        imported = set()
         with fiona.collection(ext_file, 'r') as input_file:
             for feature in input_file:
                 # Verify proper profile
-                if feature['properties'][profile_field] != profile:
+                temp_profile = feature['properties'][profile_field]
+                if wanted is not None and temp_profile not in wanted:
                     continue
 
                 xs_id = feature['properties'][id_field]
+                xs = self.xs_index.get(xs_id)
+                # If the cross section doesn't exist, ignore the extent
+                if xs is None:
+                    continue
+
                 position = feature['properties'][pos_field]
                 elevation = feature['properties'][elev_field]
                 temp_geo = shape(feature['geometry'])
@@ -280,19 +946,37 @@ class Manager(object):
                     print 'Extent for cross section', xs_id, 'is type', type(temp_geo), ', should be Point. Ignoring.'
                     continue
 
-                geo = gt.ADPoint(shapely_geo=temp_geo)
-                xs = get_xs(xs_id)
-                # If the cross section doesn't exist, ignore the extent
-                if xs is None:
+                if position != self.left and position != self.right:
+                    print 'Extent for cross section', xs_id, 'has position', position, 'which is neither', self.left, \
+                        'nor', self.right, 'Ignoring.'
                     continue
-                xs.elevation = elevation
+
+                geo = gt.ADPoint(shapely_geo=temp_geo)
+                extents = xs.profiles.get(temp_profile)
+                if extents is None:
+                    extents = xs.profiles[temp_profile] = ProfileExtents()
+                extents.elevation = elevation
                 if position == self.left:
-                    xs.left_extent = geo
-                elif position == self.right:
-                    xs.right_extent = geo
+                    extents.left_extent = geo
                 else:
-                    print 'Extent for cross section', xs_id, 'has position', position, 'which is neither', self.left, \
-                        'nor', self.right, 'Ignoring.'
+                    extents.right_extent = geo
+                imported.add(temp_profile)
+
+        if wanted is not None and wanted - imported:
+            print 'No extents found for profile(s):', ', '.join(str(x) for x in sorted(wanted - imported))
+        if isinstance(profile, basestring):
+            self.set_profile(profile)
+        return sorted(imported)
+
+    def set_profile(self, profile):
+        """
+        Selects the profile used for delineation. Cross sections without extents for profile are skipped. For
+        run_single_reach(), select BFE/XS again (_select_bfe_xs() etc.) after changing profile.
+        :param profile: string - profile name, must be imported with import_extents()
+        """
+        self.profile = profile
+        for xs in self.xs_index.values():
+            xs.set_profile(profile)
 
     def import_multi_river(self, river_file, river_field, reach_field):
         """
@@ -304,6 +988,7 @@ class Manager(object):
         :param reach_field: string - name of reachcode attribute filed
         """
         self.rivers = Rivers()
+        self._clear_join()
         with fiona.collection(river_file, 'r') as input_file:
             for feature in input_file:
                 # Fiona might give a Linestring or a MultiLineString, handle both cases
@@ -316,7 +1001,7 @@ class Manager(object):
                     river_name = feature['properties'][river_field]
                     reach_name = feature['properties'][reach_field]
                     temp_river = River(geo, river_name, reach_name)
-                    self.rivers.reaches.append(temp_river)
+                    self.rivers.add(temp_river)
                 else:
                     raise ShapefileError('Feature in ' + river_file + ' is not a Linestring.')
 
@@ -340,6 +1025,7 @@ class Manager(object):
             elif type(temp_geo) is LineString:
                 geo = gt.ADPolyline(shapely_geo=temp_geo)
                 self.river = River(geo, None, None)
+                self._clear_join()
             else:
                 raise ShapefileError('Feature in ' + river_file + ' is not a Linestring.')
 
@@ -362,7 +1048,11 @@ class Manager(object):
                     raise ShapefileError('Cross section' + str(xs_id) + 'is type' + str(type(temp_geo)) +
                                          ', should be LineString.')
                 geo = gt.ADPolyline(shapely_geo=temp_geo)
-                self.full_combo_list.append(CrossSection(geo, xs_id))
+                xs = CrossSection(geo, xs_id)
+                self.full_combo_list.append(xs)
+                # Extents go to the first cross section with an id
+                self.xs_index.setdefault(xs_id, xs)
+        self._clear_join()
 
     def run_all_reaches(self):
         """
@@ -377,15 +1067,72 @@ class Manager(object):
 
     def run_multi_reach(self, river_reach_list):
         """
-        Delineates river/reach combos in river_reach_list. Returns boundary
+        Delineates river/reach combos in river_reach_list. Returns boundary. Reaches are started longest first and
+        share the contours and worker pool, with workers the next reach is prepared while segments of the previous
+        reaches run.
+        :param river_reach_list: list of tuples: (river, reach)
+        :return: list of ADPolylines
+        """
+        return self.run_reach_jobs(self._reach_jobs(river_reach_list))
+
+    def join_features(self):
+        """
+        Assigns BFE/XS to every imported reach with one spatial join, see join_features(). Selecting BFE/XS for a reach
+        is then a lookup. Runs automatically the first time BFE/XS are selected after an import.
+        """
+        reaches = self._all_reaches()
+        join_features(reaches, self.full_combo_list)
+        self._joined = True
+        print 'Assigned', sum(len(x.features) for x in reaches), 'BFE/XS crossings to', len(reaches), 'reaches'
+
+    def _join_if_needed(self):
+        if not self._joined:
+            self.join_features()
+
+    def _clear_join(self):
+        """ BFE/XS or reaches have changed, the join must be done again """
+        for river in self._all_reaches():
+            river.features = None
+        self._joined = False
+
+    def _all_reaches(self):
+        """ Returns list of River objects from self.rivers and self.river """
+        reaches = list(self.rivers.reaches) if self.rivers is not None else []
+        if self.river is not None and self.river not in reaches:
+            reaches.append(self.river)
+        return reaches
+
+    def _reach_jobs(self, river_reach_list):
+        """
+        Creates ReachJobs for river/reach combos in river_reach_list
         :param river_reach_list: list of tuples: (river, reach)
+        :return: list of ReachJob objects
+        """
+        self._join_if_needed()
+        jobs = []
+        for river, reach in river_reach_list:
+            river_obj = self.rivers.get_reach(river, reach)
+            if river_obj is None:
+                raise ValueError('River/reach '+river+'/'+reach+' not found in rivers')
+            jobs.append(ReachJob(river_obj, self.full_combo_list))
+        return jobs
+
+    def run_reach_jobs(self, jobs):
+        """
+        Delineates ReachJobs. Returns boundary in the same order as jobs
+        :param jobs: list of ReachJob objects
         :return: list of ADPolylines
         """
+        for job in jobs:
+            if len(job.combo_list) < 2:
+                raise ValueError('Reach ' + str(job) + ' has less than two BFE/XS. Unable to delineate.')
+        self.start_workers()
+        self._set_segment_cache()
+        results = logic.delineate_reaches([job.combo_list for job in jobs], self.contours, workers=self.workers,
+                                          engine=self.engine, pool=self._pool, names=[str(job) for job in jobs])
         boundary = []
-        for i, river_reach in enumerate(river_reach_list):
-            print '################ Processing reaching number', i+1, 'of', len(river_reach_list)+1
-            b = self.run_named_reach(river_reach)
-            boundary += b
+        for result in results:
+            boundary += result
         return boundary
 
     def run_named_reach(self, river_reach):
@@ -436,9 +1183,59 @@ class Manager(object):
         if len(self.combo_list) < 2:
             raise ValueError('self.combo_list has less than two elements. Unable to delineate.')
 
-        boundary = logic.delineate(self.combo_list, self.contours, workers=self.workers)
+        self.start_workers()
+        self._set_segment_cache()
+        boundary = logic.delineate(self.combo_list, self.contours, workers=self.workers, engine=self.engine,
+                                   concurrent=self.concurrent, pool=self._pool)
         return boundary
 
+    def run_profiles(self, profiles=None, river_reach_list=None, start=None, end=None):
+        """
+        Delineates several profiles in one run, e.g. 10, 50, 100 and 500-yr or a Monte-Carlo set of water surfaces.
+        Profiles must be imported with import_extents(). Segments that have the same contours and clip window in
+        different profiles share crossing lines, see logic.delineate_profiles(). The segment cache isn't used. The
+        active profile is restored afterwards.
+        :param profiles: list of profile names, None for all imported profiles
+        :param river_reach_list: list of tuples: (river, reach), None for the single reach in self.river
+        :param start: lowest elevation bfe/cross section to use with the single reach, None for all
+        :param end: highest elevation bfe to use with the single reach, None for all
+        :return: OrderedDict - list of boundary ADPolylines by profile, labeled as with export_stream()
+        """
+        if profiles is None:
+            profiles = set()
+            for xs in self.xs_index.values():
+                profiles.update(xs.profiles)
+            profiles = sorted(profiles)
+        if river_reach_list is None and self.river is None:
+            raise ValueError('self.river has not been defined yet')
+        if river_reach_list is not None and self.rivers is None:
+            raise ValueError('self.rivers has not been defined yet')
+
+        self.start_workers()
+        self._join_if_needed()
+        active = self.profile
+        jobs = []
+        try:
+            for profile in profiles:
+                print '============= Preparing profile:', profile
+                self.set_profile(profile)
+                if river_reach_list is None:
+                    reach_jobs = [ReachJob(self.river, self.full_combo_list, start, end)]
+                else:
+                    reach_jobs = self._reach_jobs(river_reach_list)
+                for reach_job in reach_jobs:
+                    if len(reach_job.combo_list) < 2:
+                        print 'Reach', str(reach_job), 'has less than two BFE/XS for profile', profile, '. Skipping.'
+                        continue
+                    for job in logic.prepare_reach(reach_job.combo_list, self.contours, self.engine, self._pool):
+                        job.reach = str(reach_job)
+                        job.profile = profile
+                        jobs.append(job)
+        finally:
+            if active is not None:
+                self.set_profile(active)
+        return logic.delineate_profiles(jobs, workers=self.workers, pool=self._pool)
+
     # def run_multi_reach_smp(self, river_reach, workers=4):
     #     """
     #     Delineates river/reach combos in river_reach using multiple processes. Returns boundary
@@ -469,6 +1266,63 @@ class Manager(object):
             for line in boundary:
                 out.write({'geometry': mapping(line.shapely_geo), 'properties': {'status': line.status}})
 
+    def export_stream(self, out_file, river_reach_list=None, batch_size=50, jobs=None):
+        """
+        Delineates reaches and appends each boundary to out_file as soon as it's done, instead of holding the
+        boundary in memory until every reach is finished. Lines are written in batches of batch_size. Records are in
+        the order segments finish.
+        :param out_file: name of shapefile to write
+        :param river_reach_list: list of tuples: (river, reach), None for all reaches in self.rivers
+        :param batch_size: int - number of lines per write
+        :param jobs: list of ReachJob objects, used instead of river_reach_list if set
+        :return: int - number of lines written
+        """
+        if jobs is None:
+            if river_reach_list is None:
+                river_reach_list = [(river.river, river.reach) for river in self.rivers.reaches]
+            jobs = self._reach_jobs(river_reach_list)
+        for job in jobs:
+            if len(job.combo_list) < 2:
+                raise ValueError('Reach ' + str(job) + ' has less than two BFE/XS. Unable to delineate.')
+
+        # Check for extension
+        if out_file[-4:] != '.shp':
+            out_file += '.shp'
+
+        self.start_workers()
+        self._set_segment_cache()
+        stream = logic.delineate_stream([job.combo_list for job in jobs], self.contours, workers=self.workers,
+                                        engine=self.engine, pool=self._pool, names=[str(job) for job in jobs])
+        count = 0
+        batch = []
+        with fiona.open(out_file, 'w', driver='ESRI Shapefile', crs=self.crs, schema=STREAM_SCHEMA) as out:
+            try:
+                for line in stream:
+                    batch.append({'geometry': mapping(line.shapely_geo),
+                                  'properties': {'status': line.status,
+                                                 'reach': line.reach,
+                                                 'side': line.side,
+                                                 'from': line.from_feature,
+                                                 'to': line.to_feature,
+                                                 'from_elev': line.from_elevation,
+                                                 'to_elev': line.to_elevation,
+                                                 # Refinement passes and 1/0 if refinement converged, not
+                                                 # known for cached segments
+                                                 'iterations': getattr(line, 'iterations', None),
+                                                 'converged': None if getattr(line, 'converged', None) is None
+                                                 else int(line.converged)}})
+                    if len(batch) >= batch_size:
+                        out.writerecords(batch)
+                        out.flush()
+                        count += len(batch)
+                        batch = []
+            finally:
+                # Keep what's done if delineation fails part way
+                if batch:
+                    out.writerecords(batch)
+                    count += len(batch)
+        return count
+
     @staticmethod
     def plot_boundary(boundary, color='blue'):
         for line in boundary:
@@ -484,30 +1338,7 @@ class Manager(object):
         :param start: lowest elevation bfe/cross section to use
         :param end: highest elevation bfe to use
         """
-        # Check for proper order
-        if self.combo_list[0].elevation > self.combo_list[-1].elevation:
-            # print 'BFE/cross section list appears to be in reverse order. Reversing.'
-            self.combo_list = self.combo_list[::-1]
-
-        # if start > end:
-        #     end, start = start, end
-
-        new_bfe_xs_list = []
-        flag = 'out'
-        for bfe_xs in self.combo_list:
-            if bfe_xs.name == start:
-                flag = 'in'
-                new_bfe_xs_list.append(bfe_xs)
-            elif flag == 'in' and bfe_xs.name != end:
-                new_bfe_xs_list.append(bfe_xs)
-            elif bfe_xs.name == end:
-                new_bfe_xs_list.append(bfe_xs)
-                break
-                # print 'bfe_xs.name=', bfe_xs.name,'start=', start,'end=', end
-        self.combo_list = new_bfe_xs_list
-        if len(self.combo_list) < 2:
-            raise ValueError('self.combo_list has less than two elements.' +
-                         ' start and end appear invalid. Are they switched?.')
+        self.combo_list = trim_bfe_xs(self.combo_list, start, end)
 
     def _calc_stations(self):
         # TODO - this appears to be redundant to _calc_bfe_stations and _calc_xs_stations
@@ -517,16 +1348,10 @@ class Manager(object):
         if self.river is None:
             raise ValueError('self.river has not been defined yet')
 
-        for item in self.combo_list:
-            temp_point = self.river.geo.intersection(item.geo)
-            if type(temp_point) is MultiPoint:
-                raise ShapefileError('BFE/XS' + str(item.name) + 'crosses channel alignment multiple times.')
-            elif temp_point is None:
-                raise ShapefileError('BFE/XS' + str(item.name) + 'does not cross channel alignment. Does ' +
-                                     'select_xs_bfe() need to be run?')
-
+        stations = ReachJob.calc_stations(self.river, self.combo_list)
+        for item, (temp_point, station) in zip(self.combo_list, stations):
             item.river_intersect = temp_point
-            item.station = self.river.geo.project(item.river_intersect)
+            item.station = station
 
     def _select_river(self, river_code, reach_code):
         """
@@ -549,15 +1374,8 @@ class Manager(object):
         :param river: ADPolyline - river
         :param combo_list: list of ADPolyline - bfes and cross sections
         """
-        self.combo_list = []
-        for item in self.full_combo_list:
-            if item.geo.crosses(self.river.geo):
-                if type(item) is logic.BFE:
-                    self.combo_list.append(item)
-                else:
-                    # Only include cross sections with extents
-                    if item.left_extent is not None and item.right_extent is not None:
-                        self.combo_list.append(item)
+        self._join_if_needed()
+        self.combo_list = ReachJob.select_bfe_xs(self.river, self.full_combo_list)
 
     def _sort_bfe_and_xs(self):
         self.combo_list.sort(key=lambda x: x.station)
@@ -571,14 +1389,16 @@ class Manager(object):
         :return: None
         """
         valid_xs = []
-        for xs in cross_sections:
-            temp_point = river.intersection(xs.geo)
-            if type(temp_point) is MultiPoint:
-                raise ChannelCrossingError('Cross section'+str(xs.id)+'crosses channel alignment multiple times. Aborting')
-            elif temp_point is None:
+        crossings = vt.LinearReference(river.coords).intersect([xs.geo.coords for xs in cross_sections])
+        multiple = [str(xs.id) for xs, (x, _) in zip(cross_sections, crossings) if len(x) > 1]
+        if multiple:
+            raise ShapefileError('Cross sections ' + ', '.join(multiple) + ' cross channel alignment multiple times.')
+        for xs, (station, point) in zip(cross_sections, crossings):
+            if len(station) == 0:
                 print 'Cross section '+str(xs.id)+' does not cross channel alignment. Aborting'
                 continue
-            xs.river_intersect = temp_point
-            xs.station = river.project(xs.river_intersect)
+            x, y = point[0].tolist()
+            xs.river_intersect = gt.ADPoint(x, y)
+            xs.station = float(station[0])
             valid_xs.append(xs)
         return
@@ -0,0 +1,40 @@
+"""
+Deferred imports for heavy optional backends (matplotlib, pathos, fiona). A LazyModule stands in for the module and
+imports it the first time an attribute is accessed, so code that never plots, runs serially or reads shapefiles
+doesn't pay for the import.
+
+Usage:
+    pyplot = LazyModule('matplotlib.pyplot')
+    pyplot.plot(x, y)   # matplotlib.pyplot is imported here
+"""
+import importlib
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        """
+        :param name: string - full module name, e.g. 'matplotlib.pyplot'
+        """
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        """ Imports module if needed and returns it """
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def is_loaded(self):
+        """ Returns True if the module has been imported """
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        if self.is_loaded():
+            return '<lazy ' + repr(self._module) + '>'
+        return '<lazy module ' + repr(self._name) + ' (not loaded)>'
@@ -1,9 +1,14 @@
 import math
+import hashlib
+from collections import OrderedDict, deque
 import geo_tools as gt
+import instrumentation as inst
 import segment
-from matplotlib import pyplot
-import pathos.multiprocessing as mp
 import datetime
+from lazy_import import LazyModule
+
+pyplot = LazyModule('matplotlib.pyplot')
+mp = LazyModule('pathos.multiprocessing')
 
 DEBUG1 = gt.DEBUG1
 DEBUG2 = gt.DEBUG2
@@ -12,6 +17,21 @@ NEW_DEBUG = False
 LEFT = 'left'
 RIGHT = 'right'
 
+# Number of upcoming BFE/XS to prefetch contours for while segmenting
+PREFETCH_SEGMENTS = 2
+
+# segment_cache.SegmentCache for segment results, None for no caching. Set with set_segment_cache()
+SEGMENT_CACHE = None
+
+
+def set_segment_cache(cache):
+    """
+    Sets cache used for segment results. Segments created afterwards use it
+    :param cache: segment_cache.SegmentCache or None to turn off caching
+    """
+    global SEGMENT_CACHE
+    SEGMENT_CACHE = cache
+
 
 class ContourNotFound(Exception):
     pass
@@ -54,13 +74,17 @@ class BFE(object):
         return str(self)
 
 
-def delineate(bfe_cross_sections, contours, workers=0):
+def delineate(bfe_cross_sections, contours, workers=0, engine=gt.SHAPELY, concurrent=False, pool=None):
     # TODO - fill out doc string
     """
 
     :param bfe_cross_sections:
     :param contours:
     :param workers: no SMP if 0, uses smp with workers workers if non zero
+    :param engine: crossing line engine, gt.SHAPELY or gt.NUMPY
+    :param concurrent: boolean - True runs the left bank segments in the background while the right bank is prepared,
+                       both banks share one pool. Requires workers
+    :param pool: pathos ProcessingPool to run segments on, a pool with workers processes is used if None
     :return:
     """
     # Check for proper order
@@ -68,12 +92,157 @@ def delineate(bfe_cross_sections, contours, workers=0):
         print 'BFE/cross section list appears to be in reverse order. Reversing.'
         bfe_cross_sections = bfe_cross_sections[::-1]
 
-    l_bound = delineate_side(bfe_cross_sections, contours, LEFT, workers)
-    r_bound = delineate_side(bfe_cross_sections, contours, RIGHT, workers)
+    if concurrent and workers:
+        now = datetime.datetime.now()
+        if pool is None:
+            pool = mp.ProcessingPool(nodes=workers)
+        l_jobs = _prepare_side(bfe_cross_sections, contours, LEFT, engine, pool)
+        submitted = [_submit_segments(l_jobs, workers, pool, LEFT)]
+        # Left segments are queued on the pool, positions sent there would wait for them. Calculate them here so the
+        # right side is prepared while the left side runs
+        r_jobs = _prepare_side(bfe_cross_sections, contours, RIGHT, engine)
+        submitted.append(_submit_segments(r_jobs, workers, pool, RIGHT))
+        return _finish_segments(submitted, now)
+
+    l_bound = delineate_side(bfe_cross_sections, contours, LEFT, workers, engine, pool)
+    r_bound = delineate_side(bfe_cross_sections, contours, RIGHT, workers, engine, pool)
     return l_bound + r_bound
 
 
-def delineate_side(bfe_cross_sections, contours, side, workers):
+def delineate_reaches(reach_list, contours, workers=0, engine=gt.SHAPELY, pool=None, names=None):
+    """
+    Delineates several reaches. Reaches are prepared longest (most BFE/XS) first. With workers, the segments of each
+    reach are sent to the pool as soon as it is prepared and run while the following reaches are prepared, so the
+    workers don't wait between sides or reaches.
+    :param reach_list: list of lists of BFE and CrossSection objects, one list per reach
+    :param contours: interface.Contours
+    :param workers: no SMP if 0, uses smp with workers workers if non zero
+    :param engine: crossing line engine, gt.SHAPELY or gt.NUMPY
+    :param pool: pathos ProcessingPool to run segments on, a pool with workers processes is used if None
+    :param names: list of strings - reach names for progress messages, optional
+    :return: list of lists of boundary ADPolylines, in the same order as reach_list
+    """
+    if names is None:
+        names = [str(i) for i in range(len(reach_list))]
+    if workers and pool is None:
+        pool = mp.ProcessingPool(nodes=workers)
+
+    # Longest first, ties stay in order
+    order = sorted(range(len(reach_list)), key=lambda i: -len(reach_list[i]))
+
+    now = datetime.datetime.now()
+    results = [None] * len(reach_list)
+    pending = []
+    for i in order:
+        print '============= Delineating reach:', names[i], '(' + str(len(reach_list[i])), 'BFE/XS)'
+        if not workers:
+            results[i] = delineate(reach_list[i], contours, engine=engine)
+            continue
+        bfe_cross_sections = reach_list[i]
+        # Check for proper order
+        if bfe_cross_sections[0].elevation > bfe_cross_sections[-1].elevation:
+            print 'BFE/cross section list appears to be in reverse order. Reversing.'
+            bfe_cross_sections = bfe_cross_sections[::-1]
+        # Once segments are queued on the pool, positions sent there would wait for them. Calculate them here so this
+        # reach is prepared while earlier reaches run
+        position_pool = None if pending else pool
+        jobs = _prepare_side(bfe_cross_sections, contours, LEFT, engine, position_pool)
+        jobs += _prepare_side(bfe_cross_sections, contours, RIGHT, engine, position_pool)
+        print 'Queued', len(jobs), 'segments for', names[i]
+        pending.append((i, pool.amap(_run_job, jobs)))
+
+    for i, result in pending:
+        boundary = _collect_results(result.get())
+        for x in boundary:
+            x.status = 'testing'
+        results[i] = boundary
+        print '============= Finished delineating:', names[i]
+    time = datetime.datetime.now() - now
+    print 'Completed', len(reach_list), 'reaches in', time, '.'
+    return results
+
+
+def delineate_stream(reach_list, contours, workers=0, engine=gt.SHAPELY, pool=None, names=None):
+    """
+    Generator version of delineate_reaches(). Yields each boundary as soon as its segment is done, in no particular
+    order with workers. Reaches are prepared longest first as they are needed. Boundaries are labeled with reach,
+    side, from/to feature and elevations, see SegmentJob.label(). A reach side that can't be prepared is reported and
+    skipped like a failed segment.
+    :param reach_list: list of lists of BFE and CrossSection objects, one list per reach
+    :param contours: interface.Contours
+    :param workers: no SMP if 0, uses smp with workers workers if non zero
+    :param engine: crossing line engine, gt.SHAPELY or gt.NUMPY
+    :param pool: pathos ProcessingPool to run segments on, a pool with workers processes is used if None
+    :param names: list of strings - reach names for boundary attributes and progress messages, optional
+    :return: generator of boundary ADPolylines
+    """
+    if names is None:
+        names = [str(i) for i in range(len(reach_list))]
+    # Prepare errors (message, None) and prepare times (None, instruments snapshot) from jobs(). With workers jobs()
+    # runs in the pool's task thread, these are reported and merged by report_prepared() in this thread
+    prepared = deque()
+
+    def jobs():
+        # Longest first, ties stay in order
+        for i in sorted(range(len(reach_list)), key=lambda x: -len(reach_list[x])):
+            print '============= Delineating reach:', names[i], '(' + str(len(reach_list[i])), 'BFE/XS)'
+            bfe_cross_sections = reach_list[i]
+            # Check for proper order
+            if bfe_cross_sections[0].elevation > bfe_cross_sections[-1].elevation:
+                print 'BFE/cross section list appears to be in reverse order. Reversing.'
+                bfe_cross_sections = bfe_cross_sections[::-1]
+            for side in (LEFT, RIGHT):
+                instruments = inst.Instruments() if gt.INSTRUMENTS.enabled else gt.INSTRUMENTS
+                # No pool, this runs in the pool's task thread and can't wait on the pool
+                try:
+                    side_jobs = _prepare_side(bfe_cross_sections, contours, side, engine, instruments=instruments)
+                except Exception as e:
+                    # Skip this side, keep going with the rest
+                    side_jobs = []
+                    prepared.append((names[i] + ' ' + side + ' side: Unable to prepare segments: ' +
+                                     type(e).__name__ + ': ' + str(e), None))
+                if instruments.enabled:
+                    prepared.append((None, instruments.snapshot()))
+                for job in side_jobs:
+                    job.reach = names[i]
+                    yield job
+
+    def report_prepared():
+        while prepared:
+            error, snapshot = prepared.popleft()
+            if error is not None:
+                print error
+            else:
+                gt.INSTRUMENTS.merge(snapshot)
+
+    if workers:
+        if pool is None:
+            pool = mp.ProcessingPool(nodes=workers)
+        # jobs() is consumed by the pool's task thread, segments start while later reaches are prepared
+        results = pool.uimap(_run_job, jobs())
+    else:
+        results = (_run_job(job) for job in jobs())
+
+    hits = 0
+    recomputed = 0
+    for boundary, error in results:
+        report_prepared()
+        if error is not None:
+            print error
+            continue
+        _merge_instruments(boundary)
+        if hasattr(boundary, 'cached'):
+            if boundary.cached:
+                hits += 1
+            else:
+                recomputed += 1
+        yield boundary
+    report_prepared()
+    if hits or recomputed:
+        print 'Segment cache:', hits, 'hits,', recomputed, 'recomputed'
+
+
+def delineate_side(bfe_cross_sections, contours, side, workers, engine=gt.SHAPELY, pool=None):
     # TODO - fill out doc string
     """
 
@@ -81,8 +250,235 @@ def delineate_side(bfe_cross_sections, contours, side, workers):
     :param contours:
     :param side: string: LEFT or RIGHT
     :param workers:
+    :param engine: crossing line engine, gt.SHAPELY or gt.NUMPY
+    :param pool: pathos ProcessingPool to run segments on, a pool with workers processes is used if None
     :return:
     """
+    if workers and pool is None:
+        pool = mp.ProcessingPool(nodes=workers)
+    jobs = _prepare_side(bfe_cross_sections, contours, side, engine, pool)
+    return _run_segments(jobs, workers, pool)
+
+
+def prepare_reach(bfe_cross_sections, contours, engine=gt.SHAPELY, pool=None):
+    """
+    Prepares segments on both sides of a reach, see _prepare_side()
+    :param bfe_cross_sections: list of BFE and CrossSection objects
+    :param contours: interface.Contours
+    :param engine: crossing line engine, gt.SHAPELY or gt.NUMPY
+    :param pool: pathos ProcessingPool for cross section positions, None to calculate in this process
+    :return: list of SegmentJob objects
+    """
+    # Check for proper order
+    if bfe_cross_sections[0].elevation > bfe_cross_sections[-1].elevation:
+        print 'BFE/cross section list appears to be in reverse order. Reversing.'
+        bfe_cross_sections = bfe_cross_sections[::-1]
+    jobs = _prepare_side(bfe_cross_sections, contours, LEFT, engine, pool)
+    jobs += _prepare_side(bfe_cross_sections, contours, RIGHT, engine, pool)
+    return jobs
+
+
+def delineate_profiles(jobs, workers=0, pool=None):
+    """
+    Delineates segments of several profiles (10/50/100/500-yr, Monte-Carlo water surfaces, ...). Jobs with the same
+    contours and clip window (see SegmentJob.window_key()) share one set of crossing lines, only the boundary
+    position is calculated for each profile. The segment cache isn't used.
+    :param jobs: list of SegmentJob objects from prepare_reach() with profile set, prepared with that profile active
+    :param workers: no SMP if 0, uses smp with workers workers if non zero
+    :param pool: pathos ProcessingPool to run segments on, a pool with workers processes is used if None
+    :return: OrderedDict - list of boundary ADPolylines by profile, in job order
+    """
+    now = datetime.datetime.now()
+    groups = OrderedDict()
+    for i, job in enumerate(jobs):
+        groups.setdefault(job.window_key(), []).append(i)
+    group_list = groups.values()
+    print 'Delineating', len(jobs), 'segments with', len(group_list), 'sets of crossing lines'
+
+    job_groups = [[jobs[i] for i in group] for group in group_list]
+    if workers:
+        if pool is None:
+            pool = mp.ProcessingPool(nodes=workers)
+        group_results = pool.map(_run_group, job_groups)
+    else:
+        group_results = [_run_group(x) for x in job_groups]
+
+    # Back to job order
+    results = [None] * len(jobs)
+    for group, group_result in zip(group_list, group_results):
+        for i, result in zip(group, group_result):
+            results[i] = result
+
+    boundary = OrderedDict()
+    for job in jobs:
+        boundary.setdefault(job.profile, [])
+    for job, (result, error) in zip(jobs, results):
+        if error is not None:
+            print error
+        else:
+            _merge_instruments(result)
+            boundary[job.profile].append(result)
+    time = datetime.datetime.now() - now
+    print 'Completed', len(jobs), 'segments for', len(boundary), 'profiles in', time, '.'
+    return boundary
+
+
+class SegmentJob(object):
+    """
+    Everything needed to clip the contours for a segment and delineate it, without the Contours. The contour parts
+    are selected by _prepare_side(), clipping, orienting and delineating happen in SegmentJob.segment() and
+    Segment.run(), on SMP workers if available.
+    """
+    def __init__(self, low_part, high_part, last_low_pt, last_high_pt, current_low_pt, current_high_pt, last_pos,
+                 current_pos, engine):
+        """
+        :param low_part: ADPolyline - part of low contour between the BFE/XS
+        :param high_part: ADPolyline - part of high contour between the BFE/XS
+        :param last_low_pt: ADPoint - clip low contour here at last BFE/XS
+        :param last_high_pt: ADPoint - clip high contour here at last BFE/XS
+        :param current_low_pt: ADPoint - clip low contour here at current BFE/XS, None if current is a BFE, see
+                               self.bfe_geo
+        :param current_high_pt: ADPoint - clip high contour here at current BFE/XS
+        :param last_pos: float - position of boundary at last BFE/XS
+        :param current_pos: float - position of boundary at current BFE/XS
+        :param engine: string - crossing line engine, gt.SHAPELY or gt.NUMPY
+        """
+        self.low_part = low_part
+        self.high_part = high_part
+        self.last_low_pt = last_low_pt
+        self.last_high_pt = last_high_pt
+        self.current_low_pt = current_low_pt
+        self.current_high_pt = current_high_pt
+        self.last_pos = last_pos
+        self.current_pos = current_pos
+        self.engine = engine
+
+        # If current is a BFE, current_low_pt is where the BFE crosses low_part closest to current_high_pt
+        self.bfe_geo = None
+        self.current_feature = None
+        self.last_feature = None
+        # Copied to the boundary by label()
+        self.reach = None
+        self.side = None
+        self.profile = None
+        self.last_elevation = None
+        self.current_elevation = None
+        # Captured here so SMP workers use the sink, instruments and cache of the main process
+        self.diagnostics = gt.DIAGNOSTICS
+        self.instruments = gt.INSTRUMENTS
+        self.cache = SEGMENT_CACHE
+
+    def __getstate__(self):
+        """ Send BFE/XS names instead of the full objects, same as segment.Segment """
+        state = self.__dict__.copy()
+        for key in ('current_feature', 'last_feature'):
+            if state[key] is not None:
+                state[key] = str(state[key])
+        return state
+
+    def trim_parts(self):
+        """
+        Cuts low_part and high_part down to the vertices around the clip points, see ADPolyline.window(), so jobs
+        don't carry whole contours to SMP workers. Finds current_low_pt first if current is a BFE. segment() gives
+        the same result afterwards
+        """
+        if self.current_low_pt is None:
+            self.current_low_pt = self.bfe_geo.nearest_intersection(self.low_part, self.current_high_pt)
+        self.low_part = self.low_part.window(self.last_low_pt, self.current_low_pt)
+        self.high_part = self.high_part.window(self.last_high_pt, self.current_high_pt)
+
+    def segment(self):
+        """
+        Clips and orients contours
+        :return: segment.Segment
+        """
+        current_low_pt = self.current_low_pt
+        if current_low_pt is None:
+            current_low_pt = self.bfe_geo.nearest_intersection(self.low_part, self.current_high_pt)
+
+        # trim contours between current and last BFE/XS
+        low_contour = _clip_line(self.low_part, self.last_low_pt, current_low_pt)
+        high_contour = _clip_line(self.high_part, self.last_high_pt, self.current_high_pt)
+
+        # force contours to point upstream
+        _orient_contours(self.last_low_pt, low_contour)
+        _orient_contours(self.last_high_pt, high_contour)
+
+        if NEW_DEBUG:
+            low_contour.plot(color='black', linewidth=2)
+            high_contour.plot(color='red')
+            low_contour.first_point.plot(marker='o')
+            low_contour.last_point.plot(marker='o')
+            high_contour.first_point.plot(marker='o')
+            high_contour.last_point.plot(marker='o')
+
+        temp_seg = segment.Segment(low_contour, high_contour, self.last_pos, self.current_pos, engine=self.engine)
+        temp_seg.current_feature = self.current_feature
+        temp_seg.last_feature = self.last_feature
+        temp_seg.diagnostics = self.diagnostics
+        temp_seg.instruments = self.instruments
+        return temp_seg
+
+    def label(self, boundary):
+        """
+        Sets reach, side, from/to feature and elevation attributes of boundary for export
+        :param boundary: ADPolyline - boundary created by this job
+        """
+        boundary.reach = self.reach
+        boundary.side = self.side
+        boundary.from_feature = str(self.last_feature)
+        boundary.to_feature = str(self.current_feature)
+        boundary.from_elevation = self.last_elevation
+        boundary.to_elevation = self.current_elevation
+        boundary.profile = self.profile
+
+    def window_key(self):
+        """
+        Returns hash of the contour parts and clip points. Jobs with the same key have the same clipped contours and
+        crossing lines, only the positions differ. Parts are trimmed by trim_parts() first, so only the vertices around
+        the clip points are hashed
+        :return: string
+        """
+        digest = hashlib.sha1()
+        points = [self.last_low_pt, self.last_high_pt, self.current_low_pt, self.current_high_pt]
+        digest.update(repr((self.engine, self.low_part.coords.shape, self.high_part.coords.shape,
+                            [None if x is None else (x.X, x.Y) for x in points])).encode())
+        digest.update(self.low_part.coords.tobytes())
+        digest.update(self.high_part.coords.tobytes())
+        if self.current_low_pt is None:
+            # Clip point is found from the BFE when the job runs
+            digest.update(self.bfe_geo.coords.tobytes())
+        return digest.hexdigest()
+
+    def __str__(self):
+        return 'Current: '+str(self.current_feature)+' Last: '+str(self.last_feature)
+
+
+def _prepare_side(bfe_cross_sections, contours, side, engine=gt.SHAPELY, pool=None, instruments=None):
+    """
+    Times _prepare_jobs() as the prepare stage, see _prepare_jobs() for other parameters
+    :param instruments: instrumentation.Instruments to record the time on, None for geo_tools.INSTRUMENTS
+    :return: list of SegmentJob objects
+    """
+    if instruments is None:
+        instruments = gt.INSTRUMENTS
+    with instruments.stage(inst.PREPARE):
+        return _prepare_jobs(bfe_cross_sections, contours, side, engine, pool)
+
+
+def _prepare_jobs(bfe_cross_sections, contours, side, engine=gt.SHAPELY, pool=None):
+    """
+    Works out the contour parts and clip points between each pair of BFE/XS on one side of the river. Cross section
+    positions are calculated independently (in parallel if pool is set) by _walk_bfe_xs(), which runs a few BFE/XS
+    ahead of the serial pass here that chains BFE/XS into last/current pairs.
+    :param bfe_cross_sections: list of BFE and CrossSection objects, in upstream order
+    :param contours: interface.Contours
+    :param side: string: LEFT or RIGHT
+    :param engine: crossing line engine, gt.SHAPELY or gt.NUMPY
+    :param pool: pathos ProcessingPool for cross section positions, None to calculate in this process. Positions
+                 wait behind anything already queued on pool, pass None if segments are queued
+    :return: list of SegmentJob objects
+    """
     # TODO - make this whole thing an object
     # Set attribute names for LEFT vs RIGHT
     if side == LEFT:
@@ -119,54 +515,52 @@ def delineate_side(bfe_cross_sections, contours, side, workers):
     if remaining_bfe_xs is None:
         raise ValueError('Unable to find valid BFE/cross section in bfe_cross_sections.')
 
-    segments = []
-    boundary = []
+    # Contour elevations needed by each remaining BFE/XS, in the order they are needed
+    needed = []
+    previous = last_bfe_xs
+    for bfe_xs in remaining_bfe_xs:
+        needed.append([math.floor(previous.elevation), math.ceil(bfe_xs.elevation), math.floor(bfe_xs.elevation)])
+        previous = bfe_xs
+
+    jobs = []
     # Loop through all the remaining BFE/XS
-    for current_bfe_xs in remaining_bfe_xs:
+    for current_bfe_xs, position, held in _walk_bfe_xs(remaining_bfe_xs, needed, contours, extent, other_extent,
+                                                        pool):
         print '--- Segmenting last', last_bfe_xs.name, 'to current', current_bfe_xs.name
         try:
-            orig_low_contour = contours.get(math.floor(last_bfe_xs.elevation))
-            orig_high_contour = contours.get(math.ceil(current_bfe_xs.elevation))
+            orig_low_contour = _held_contour(held, contours, math.floor(last_bfe_xs.elevation))
+            orig_high_contour = _held_contour(held, contours, math.ceil(current_bfe_xs.elevation))
             # Calculate current high and low points for clipping contours
             if type(current_bfe_xs) is BFE:
                 # current_high_pt is last vertex on BFE
                 current_position = 1
                 current_high_pt = getattr(current_bfe_xs, end_point)
-                # current_low_pt is found by intersecting current BFE w/ low contour
-                temp_low_contour = _closest_contour_segment(orig_low_contour, getattr(current_bfe_xs, end_point))
-                current_low_pt = current_bfe_xs.geo.nearest_intersection(temp_low_contour, getattr(current_bfe_xs,
-                                                                                                   end_point))
+                # current_low_pt is found by intersecting current BFE w/ low contour, see SegmentJob.segment()
+                current_low_pt = None
+                low_part = _select_part(orig_low_contour, last_low_pt, current_high_pt)
             else:  # CrossSection
-                current_position, current_high_pt, current_low_pt = \
-                    _calc_extent_position(current_bfe_xs, getattr(current_bfe_xs, extent),
-                                          getattr(current_bfe_xs, other_extent), contours)
+                if isinstance(position, Exception):
+                    raise position
+                current_position, current_high_pt, current_low_pt = position
                 # Ignore extent if outside of contours
                 if current_position < 0:
                     print 'Bad extent, ignoring.'
                     continue
+                low_part = _select_part(orig_low_contour, last_low_pt, current_low_pt)
+            high_part = _select_part(orig_high_contour, last_high_pt, current_high_pt)
 
-            # print 'last low pt',type(last_low_pt), last_low_pt, 'current_low_pt', type(current_low_pt), current_low_pt
-            # trim contours between current and last BFE/XS
-            low_contour = _clip_to_bfe(orig_low_contour, last_low_pt, current_low_pt)
-            high_contour = _clip_to_bfe(orig_high_contour, last_high_pt, current_high_pt)
-
-            # force contours to point upstream
-            _orient_contours(last_low_pt, low_contour)
-            _orient_contours(last_high_pt, high_contour)
-
-            if NEW_DEBUG:
-                low_contour.plot(color='black', linewidth=2)
-                high_contour.plot(color='red')
-                low_contour.first_point.plot(marker='o')
-                low_contour.last_point.plot(marker='o')
-                high_contour.first_point.plot(marker='o')
-                high_contour.last_point.plot(marker='o')
-
-            # Create segment and add to list
-            temp_seg = segment.Segment(low_contour, high_contour, last_position, current_position)
-            temp_seg.current_feature = current_bfe_xs
-            temp_seg.last_feature = last_bfe_xs
-            segments.append(temp_seg)
+            # Create job and add to list
+            job = SegmentJob(low_part, high_part, last_low_pt, last_high_pt, current_low_pt, current_high_pt,
+                             last_position, current_position, engine)
+            if type(current_bfe_xs) is BFE:
+                job.bfe_geo = current_bfe_xs.geo
+            job.current_feature = current_bfe_xs
+            job.last_feature = last_bfe_xs
+            job.side = side
+            job.last_elevation = last_bfe_xs.elevation
+            job.current_elevation = current_bfe_xs.elevation
+            job.trim_parts()
+            jobs.append(job)
 
         except ComplexContourError:
             print 'Funky contour - skipping'
@@ -193,27 +587,324 @@ def delineate_side(bfe_cross_sections, contours, side, workers):
         else:
             last_position = current_position
 
-    # ---------------- run segments -----------------
+    contours.pin([])
+    contours.prefetch([])
+    print 'Contour cache:', _format_cache_stats(contours.stats())
+    return jobs
+
+
+def _walk_bfe_xs(remaining_bfe_xs, needed, contours, extent, other_extent, pool=None):
+    """
+    Walks BFE/XS once for _prepare_jobs(): fetches the contours each one needs and starts cross section positions
+    (on pool if set). With a pool, BFE/XS are handed back a few places behind the walk so positions run in parallel.
+    The fetched contours are handed back with the BFE/XS so each contour is decoded once per side.
+    :param remaining_bfe_xs: list of BFE and CrossSection objects, in upstream order
+    :param needed: list of lists of contour elevations needed by each BFE/XS
+    :param contours: interface.Contours
+    :param extent: string - name of extent attribute for this side
+    :param other_extent: string - name of extent attribute for the other side
+    :param pool: pathos ProcessingPool for cross section positions, None to calculate in this process
+    :return: generator of (BFE/XS, position, dict of Contour objects by elevation). Position is (position, high
+             point, low point) or exception for cross sections, None for BFEs
+    """
+    ahead = 0 if pool is None else max(PREFETCH_SEGMENTS, pool.nodes)
+    pending = deque()
+    for i, bfe_xs in enumerate(remaining_bfe_xs):
+        _cache_for(contours, needed, i)
+        held = {}
+        for elevation in needed[i]:
+            if elevation in contours.contours:
+                held[elevation] = contours.get(elevation)
+        position = None
+        if type(bfe_xs) is not BFE:
+            # Select contour parts here, intersecting them with the cross section is done by _extent_position_job()
+            try:
+                high_part, low_part = _select_extent_parts(bfe_xs, getattr(bfe_xs, extent), contours)
+            except Exception as e:
+                position = e
+            else:
+                args = (bfe_xs.geo, getattr(bfe_xs, extent), getattr(bfe_xs, other_extent), high_part, low_part)
+                if pool is None:
+                    position = _extent_position_job(args)
+                else:
+                    position = pool.apipe(_extent_position_job, args)
+        pending.append((bfe_xs, position, held))
+        if len(pending) > ahead:
+            yield _collect_position(pending.popleft())
+    while pending:
+        yield _collect_position(pending.popleft())
+
+
+def _collect_position(item):
+    """ Waits for the position started by _walk_bfe_xs() if it's running on the pool """
+    bfe_xs, position, held = item
+    if hasattr(position, 'get'):
+        position = position.get()
+    return bfe_xs, position, held
+
+
+def _held_contour(held, contours, elevation):
+    """
+    Returns contour at elevation from held, or from contours if it wasn't fetched by _walk_bfe_xs(). The latter
+    raises the usual error for a missing contour
+    """
+    if elevation in held:
+        return held[elevation]
+    return contours.get(elevation)
+
+
+def _cache_for(contours, needed, i):
+    """
+    Pins contours for BFE/XS i and prefetches contours for the next few
+    :param contours: interface.Contours
+    :param needed: list of lists of contour elevations needed by each BFE/XS
+    :param i: int - index in needed
+    """
+    # Keep the contours for this segment cached, the high contour is the next segment's low contour
+    contours.pin(needed[i])
+    # Decode contours for the next few BFE/XS in the background
+    upcoming = []
+    for elevations in needed[i + 1:i + 1 + PREFETCH_SEGMENTS]:
+        upcoming.extend(x for x in elevations if x not in upcoming)
+    contours.prefetch(upcoming)
+
+
+def _run_segments(jobs, workers, pool=None):
+    """
+    Clips contours and runs segments
+    :param jobs: list of SegmentJob objects
+    :param workers: no SMP if 0, uses smp with workers workers if non zero
+    :param pool: pathos ProcessingPool to run segments on, a pool with workers processes is used if None
+    :return: list of boundary ADPolylines
+    """
     now = datetime.datetime.now()
+    if workers and pool is None:
+        pool = mp.ProcessingPool(nodes=workers)
+    return _finish_segments([_submit_segments(jobs, workers, pool)], now)
+
+
+def _submit_segments(jobs, workers, pool, side=None):
+    """
+    Starts jobs on pool, or runs them in this process if workers is 0
+    :param jobs: list of SegmentJob objects
+    :param workers: no SMP if 0, uses pool if non zero
+    :param pool: pathos ProcessingPool
+    :param side: string - LEFT or RIGHT for the progress message, optional
+    :return: list of _run_job() results, or pool result with get() for them
+    """
     if workers == 0:  # Don't use SMP
         print 'Delineating segments (no SMP)'
-        for current_segment in segments:
-            print str(current_segment)
-            result = current_segment.run()
-            result.status = 'testing'
-            boundary.append(result)
-    else:
-        pool = mp.ProcessingPool(workers=workers)
-        print 'Delineating', len(segments), 'segments with', workers, 'sub processes.'
-        boundary = list(pool.map(segment.run_seg, segments))
-    time = datetime.datetime.now() - now
-    print 'Completed', len(segments), 'in', time, '.', (time/len(segments)), 'per segment.'
+        results = []
+        for job in jobs:
+            print str(job)
+            results.append(_run_job(job))
+        return results
+    print 'Delineating', len(jobs), (side + ' ' if side else '') + 'segments with', workers, 'sub processes.'
+    return pool.amap(_run_job, jobs)
+
+
+def _finish_segments(submitted, start):
+    """
+    Waits for segments from _submit_segments(), reports errors and timing and returns the boundaries
+    :param submitted: list of _submit_segments() results
+    :param start: datetime - when delineation started, for the timing message
+    :return: list of boundary ADPolylines
+    """
+    results = []
+    for result in submitted:
+        results += result if type(result) is list else result.get()
+    boundary = _collect_results(results)
+    time = datetime.datetime.now() - start
+    print 'Completed', len(boundary), 'in', time, '.', (time/max(len(boundary), 1)), 'per segment.'
 
     for x in boundary:
         x.status = 'testing'
     return boundary
 
 
+def _run_job(job, use_cache=True):
+    """
+    Clips contours and runs segment for job. Contour problems are returned instead of raised so one bad segment
+    doesn't stop the others. With instruments enabled, the boundary carries the job's times and counts back to the
+    main process as boundary.instruments, see _merge_instruments()
+    :param job: SegmentJob
+    :param use_cache: bool - False ignores job.cache
+    :return: boundary ADPolyline or None, error message or None
+    """
+    if job.instruments.enabled:
+        # Record this job on its own so the results can be sent back from SMP workers
+        job.instruments = inst.Instruments()
+    shapely_calls = gt.shapely_calls()
+    temp_seg, error = _segment_job(job)
+    if error is not None:
+        return None, error
+    if job.cache is None or not use_cache:
+        boundary, error = _run_segment(job, temp_seg)
+        if error is not None:
+            return None, error
+    else:
+        # Only run segment if its inputs have changed
+        key = job.cache.key(temp_seg)
+        coords = job.cache.get(key)
+        if coords is not None:
+            boundary = gt.ADPolyline(coords=coords)
+            boundary.cached = True
+        else:
+            boundary, error = _run_segment(job, temp_seg)
+            if error is not None:
+                return None, error
+            try:
+                job.cache.put(key, boundary)
+            except Exception as e:
+                # A failed cache write only costs a recompute next run
+                print str(job) + ': Unable to write segment cache: ' + str(e)
+            boundary.cached = False
+    job.label(boundary)
+    boundary.status = 'testing'
+    if job.instruments.enabled:
+        job.instruments.count(inst.SEGMENTS)
+        job.instruments.count(inst.SHAPELY_CALLS, gt.shapely_calls() - shapely_calls)
+        if getattr(boundary, 'cached', False):
+            job.instruments.count(inst.SEGMENTS_CACHED)
+        boundary.instruments = job.instruments.snapshot()
+    return boundary, None
+
+
+def _segment_job(job):
+    """
+    Clips contours for job, timed as the clip stage. Contour problems are returned instead of raised
+    :param job: SegmentJob
+    :return: segment.Segment or None, error message or None
+    """
+    try:
+        with job.instruments.stage(inst.CLIP):
+            return job.segment(), None
+    except ComplexContourError:
+        return None, str(job) + ': Funky contour - skipping'
+    except gt.UnknownIntersection:
+        return None, str(job) + ': Contour doesn\'t intersect BFE/cross section'
+    except Exception as e:
+        return None, str(job) + ': Unknown exception: ' + str(e)
+
+
+def _run_segment(job, temp_seg):
+    """
+    Runs segment for job. Errors, e.g. zero length crossing lines, are returned like _segment_job() does
+    :param job: SegmentJob
+    :param temp_seg: segment.Segment from job.segment()
+    :return: boundary ADPolyline or None, error message or None
+    """
+    try:
+        return temp_seg.run(), None
+    except Exception as e:
+        return None, str(job) + ': Unable to delineate: ' + type(e).__name__ + ': ' + str(e)
+
+
+def _run_group(jobs):
+    """
+    Delineates jobs that share contours and clip window with one set of crossing lines, see delineate_profiles().
+    With diagnostics enabled every job is run on its own so each gets a full trace. The segment cache isn't used
+    :param jobs: list of SegmentJob objects with the same window_key()
+    :return: list of (boundary ADPolyline or None, error message or None), one per job
+    """
+    first = jobs[0]
+    if first.diagnostics.enabled:
+        return [_run_job(job, use_cache=False) for job in jobs]
+    if first.instruments.enabled:
+        # One recorder for the group, sent back with the first boundary
+        first.instruments = inst.Instruments()
+        for job in jobs[1:]:
+            job.instruments = first.instruments
+    shapely_calls = gt.shapely_calls()
+    temp_seg, error = _segment_job(first)
+    if error is not None:
+        return [(None, error)] * len(jobs)
+    try:
+        fan = temp_seg.fan()
+    except Exception as e:
+        return [(None, str(job) + ': Unable to delineate: ' + type(e).__name__ + ': ' + str(e)) for job in jobs]
+
+    results = []
+    for job in jobs:
+        try:
+            boundary = fan.boundary(job.last_pos, job.current_pos, temp_seg.diagnostics, temp_seg.instruments)
+        except Exception as e:
+            results.append((None, str(job) + ': Unable to delineate: ' + type(e).__name__ + ': ' + str(e)))
+            continue
+        job.label(boundary)
+        boundary.status = 'testing'
+        results.append((boundary, None))
+    done = [boundary for boundary, error in results if boundary is not None]
+    if first.instruments.enabled and done:
+        first.instruments.count(inst.SEGMENTS, len(done))
+        first.instruments.count(inst.FANS_REUSED, len(jobs) - 1)
+        first.instruments.count(inst.SHAPELY_CALLS, gt.shapely_calls() - shapely_calls)
+        done[0].instruments = first.instruments.snapshot()
+    return results
+
+
+def _collect_results(results):
+    """
+    Prints errors from _run_job() results and returns the boundaries
+    :param results: list of (boundary, error) tuples from _run_job()
+    :return: list of boundary ADPolylines
+    """
+    boundary = []
+    for result, error in results:
+        if error is not None:
+            print error
+        else:
+            _merge_instruments(result)
+            boundary.append(result)
+    _print_cache_report(boundary)
+    return boundary
+
+
+def _merge_instruments(boundary):
+    """
+    Adds times and counts recorded by _run_job() to geo_tools.INSTRUMENTS
+    :param boundary: boundary ADPolyline from _run_job()
+    """
+    if hasattr(boundary, 'instruments'):
+        gt.INSTRUMENTS.merge(boundary.instruments)
+        del boundary.instruments
+
+
+def _print_cache_report(boundary):
+    """
+    Prints segment cache hits vs recomputed segments, if the cache was used
+    :param boundary: list of boundary ADPolylines from _run_job()
+    """
+    cached = [x.cached for x in boundary if hasattr(x, 'cached')]
+    if cached:
+        print 'Segment cache:', sum(cached), 'hits,', len(cached) - sum(cached), 'recomputed'
+
+
+def _extent_position_job(args):
+    """
+    Calculates cross section position from contour parts selected by _select_extent_parts(). Errors are returned,
+    _prepare_side() raises them when it gets to the cross section
+    :param args: tuple - xs geometry, extent, other extent, high contour part, low contour part
+    :return: (position, high point, low point) or exception
+    """
+    try:
+        return _extent_position(*args)
+    except Exception as e:
+        return e
+
+
+def _format_cache_stats(stats):
+    """
+    Formats Contours.stats() for printing
+    :param stats: dict from Contours.stats()
+    :return: string
+    """
+    return (stats['policy'] + ' policy, ' + str(stats['hits']) + ' hits, ' + str(stats['prefetch_hits']) +
+            ' prefetched, ' + str(stats['misses']) + ' misses, ' +
+            str(stats['evictions']) + ' evictions, ' + str(stats['cached_contours']) + ' contours cached, ' +
+            '%.1f MB resident, %.1f MB peak' % (stats['resident_bytes'] / 1e6, stats['peak_bytes'] / 1e6))
+
+
 def _clip_to_bfe(contour, point1, point2):
     """
     returns segment of contour between points on line nearest point1 and point2
@@ -222,17 +913,37 @@ def _clip_to_bfe(contour, point1, point2):
     :param point2: ADPoint
     :return: ADPolyline
     """
+    return _clip_line(_select_part(contour, point1, point2), point1, point2)
+
+
+def _select_part(contour, point1, point2):
+    """
+    returns part of contour nearest to point1 and point2
+    :param contour: Contour object
+    :param point1: ADPoint
+    :param point2: ADPoint
+    :return: ADPolyline
+    """
     if contour.multipart:
         # Find segment nearest to both points
-        index1 = _closest_segment_by_index(contour.line_list, point1)
-        index2 = _closest_segment_by_index(contour.line_list, point2)
+        index1 = contour.closest_part(point1)
+        index2 = contour.closest_part(point2)
         # If not on same segment raise ComplexContourError
         if index1 != index2:
             raise ComplexContourError
-        contour_poly = contour.line_list[index1]
+        return contour.line_list[index1]
     else:
-        contour_poly = contour[0]
+        return contour.line_list[0]
+
 
+def _clip_line(contour_poly, point1, point2):
+    """
+    returns segment of contour_poly between points on line nearest point1 and point2
+    :param contour_poly: ADPolyline
+    :param point1: ADPoint
+    :param point2: ADPoint
+    :return: ADPolyline
+    """
     if DEBUG1:
         print 'contour in _clip_to_bfe first/last point', contour_poly.first_point, contour_poly.last_point
     # Find nearest points to point1 and point2 on contour
@@ -240,24 +951,6 @@ def _clip_to_bfe(contour, point1, point2):
     point2 = contour_poly.point_at_distance(contour_poly.project(point2))
     return contour_poly.clip(point1, point2)
 
-# TODO - next two functions are ugly and should likely be in the contour object
-def _closest_segment_by_index(line_list, point):
-        """
-        Returns index of line (contour) in line_list that is closest to point
-        :param line_list: list of ADPolylines
-        :param point: ADPoint
-        :return: int
-        """
-        index = 0
-        #print ' in closest_segment-', type(point)
-        current_dist = line_list[0].distance_to(point)
-        for i in range(1, len(line_list)):
-            dist = line_list[i].distance_to(point)
-            if dist < current_dist:
-                current_dist = dist
-                index = i
-        return index
-
 
 def _closest_contour_segment(contour, point):
     """
@@ -266,7 +959,7 @@ def _closest_contour_segment(contour, point):
     :param point: ADPoint object
     :return: ADPolyline object
     """
-    i = _closest_segment_by_index(contour.line_list, point)
+    i = contour.closest_part(point)
     return contour.line_list[i]
 
 
@@ -279,6 +972,37 @@ def _calc_extent_position(xs, extent, other_extent, contours):
     :param contours: contour list
     :return: float, -1 if outside contours, -2 if other error, high point and low point
     """
+    if type(xs) is BFE:
+        raise ValueError('BFE passed to _calc_extent_position().')
+    high_contour, low_contour = _select_extent_parts(xs, extent, contours)
+    return _extent_position(xs.geo, extent, other_extent, high_contour, low_contour)
+
+
+def _select_extent_parts(xs, extent, contours):
+    """
+    Returns parts of the contours above and below cross section elevation closest to extent
+    :param xs: CrossSection object
+    :param extent: ADPoint
+    :param contours: Contours object
+    :return: ADPolyline, ADPolyline - high contour part, low contour part
+    """
+    high_contour = contours.get(math.ceil(xs.elevation))
+    high_contour = _closest_contour_segment(high_contour, extent)
+    low_contour = contours.get(math.floor(xs.elevation))
+    low_contour = _closest_contour_segment(low_contour, extent)
+    return high_contour, low_contour
+
+
+def _extent_position(xs_geo, extent, other_extent, high_contour, low_contour):
+    """
+    Position calculation for _calc_extent_position() using contour parts from _select_extent_parts()
+    :param xs_geo: ADPolyline - cross section geometry
+    :param extent: ADPoint
+    :param other_extent: ADPoint - extent on other side of river
+    :param high_contour: ADPolyline - high contour part
+    :param low_contour: ADPolyline - low contour part
+    :return: float, -1 if outside contours, high point and low point
+    """
     def simplify(points):
         """ reduces list of ADPoints to the point closest to extent """
         if type(points) is gt.ADPoint:
@@ -289,17 +1013,9 @@ def _calc_extent_position(xs, extent, other_extent, contours):
         else:
             return None
 
-    if type(xs) is BFE:
-        raise ValueError('BFE passed to _calc_extent_position().')
-
-    high_contour = contours.get(math.ceil(xs.elevation))
-    high_contour = _closest_contour_segment(high_contour, extent)
-    low_contour = contours.get(math.floor(xs.elevation))
-    low_contour = _closest_contour_segment(low_contour, extent)
-
     # Cross section contour intersections
-    high_point = simplify(high_contour.intersection(xs.geo))
-    low_point = simplify(low_contour.intersection(xs.geo))
+    high_point = simplify(high_contour.intersection(xs_geo))
+    low_point = simplify(low_contour.intersection(xs_geo))
 
     # Check for no intersect and us nearest point
     if high_point is None:
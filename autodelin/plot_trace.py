@@ -0,0 +1,56 @@
+"""
+Renders trace files written by diagnostics.TraceRecorder.
+
+Usage:
+    python plot_trace.py trace1.npz [trace2.npz ...] [--out image.png]
+"""
+import argparse
+import numpy as np
+from matplotlib import pyplot
+import diagnostics as diag
+
+
+def plot_trace(file_name, labels=True):
+    """
+    Plots contours, crossing lines, refinement iterations and boundary from a trace file on the current axes
+    :param file_name: string - .npz trace file
+    :param labels: boolean - True labels crossing lines with their index
+    """
+    trace = np.load(file_name)
+    if diag.LOW_CONTOUR in trace:
+        pyplot.plot(trace[diag.LOW_CONTOUR][:, 0], trace[diag.LOW_CONTOUR][:, 1], color='black')
+    if diag.HIGH_CONTOUR in trace:
+        pyplot.plot(trace[diag.HIGH_CONTOUR][:, 0], trace[diag.HIGH_CONTOUR][:, 1], color='red')
+    if diag.RAW_LINES in trace:
+        for line in trace[diag.RAW_LINES]:
+            pyplot.plot(line[:, 0], line[:, 1], color='grey', linewidth=0.5)
+    if diag.CROSSING_LINES in trace:
+        for i, line in enumerate(trace[diag.CROSSING_LINES]):
+            pyplot.plot(line[:, 0], line[:, 1], color='orange', linewidth=1, marker='^')
+            if labels:
+                pyplot.annotate(str(i), xy=line.mean(axis=0))
+    if diag.REFINEMENT in trace:
+        for points in trace[diag.REFINEMENT]:
+            pyplot.plot(points[:, 0], points[:, 1], color='cyan', linewidth=0.5, linestyle='--')
+    if diag.BOUNDARY in trace:
+        pyplot.plot(trace[diag.BOUNDARY][:, 0], trace[diag.BOUNDARY][:, 1], color='blue', linewidth=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plot autodelin trace files')
+    parser.add_argument('traces', nargs='+', help='.npz files written by diagnostics.TraceRecorder')
+    parser.add_argument('--out', help='save plot to this file instead of showing it')
+    parser.add_argument('--no-labels', action='store_true', help='don\'t label crossing lines')
+    args = parser.parse_args()
+
+    for file_name in args.traces:
+        plot_trace(file_name, labels=not args.no_labels)
+    pyplot.axes().set_aspect('equal', 'datalim')
+    if args.out:
+        pyplot.savefig(args.out)
+    else:
+        pyplot.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,80 @@
 import geo_tools as gt
+import vector_tools as vt
+import instrumentation as inst
+
+# Crossing line engines by name
+ENGINES = {gt.SHAPELY: gt.draw_line_between_contours,
+           gt.NUMPY: vt.draw_line_between_contours}
+
+# Crossing line fans by engine name, for delineating several profiles with one set of crossing lines
+FANS = {gt.SHAPELY: gt.crossing_line_fan,
+        gt.NUMPY: vt.crossing_line_fan}
 
 
 class Segment(object):
     """
     Stores information required to delineate a segment of floodplain between two contours. This is used for SMP.
     """
-    def __init__(self, low_contour, high_contour, last_pos, current_pos):
+    def __init__(self, low_contour, high_contour, last_pos, current_pos, engine=gt.SHAPELY):
+        """
+        :param low_contour: ADPolyline - clipped low contour
+        :param high_contour: ADPolyline - clipped high contour
+        :param last_pos: float - position of boundary at last BFE/XS
+        :param current_pos: float - position of boundary at current BFE/XS
+        :param engine: string - crossing line engine, gt.SHAPELY or gt.NUMPY
+        """
+        if engine not in ENGINES:
+            raise ValueError('engine was set to '+str(engine)+'. engine must be one of '+str(ENGINES.keys()))
         self.low_contour = low_contour
         self.high_contour = high_contour
         self.last_pos = last_pos
         self.current_pos = current_pos
+        self.engine = engine
 
         self.current_feature = None
         self.last_feature = None
+        # Diagnostics sink is captured when the segment is created so it goes to SMP workers with the segment
+        self.diagnostics = gt.DIAGNOSTICS
+        # Same for stage timers and counters
+        self.instruments = gt.INSTRUMENTS
         # TODO - Add cross sections and contours to this list and check for intersections after running, update status
 
+    def __getstate__(self):
+        """
+        Segments are pickled to go to SMP workers. Send the BFE/XS names instead of the full objects, workers only use
+        them to name the segment. The contours pickle as coordinate arrays, see ADPolyline.__getstate__()
+        """
+        state = self.__dict__.copy()
+        for key in ('current_feature', 'last_feature'):
+            if state[key] is not None:
+                state[key] = str(state[key])
+        return state
+
     def run(self):
-        return gt.draw_line_between_contours(self.low_contour, self.high_contour, self.last_pos, self.current_pos)
+        with self.instruments.stage(inst.SEGMENT):
+            return self._run()
+
+    def _run(self):
+        draw_line = ENGINES[self.engine]
+        if not self.diagnostics.enabled:
+            return draw_line(self.low_contour, self.high_contour, self.last_pos, self.current_pos, self.diagnostics,
+                             self.instruments)
+        # Write the trace even if delineation fails, that's when it's most useful
+        self.diagnostics.begin(str(self))
+        try:
+            return draw_line(self.low_contour, self.high_contour, self.last_pos, self.current_pos, self.diagnostics,
+                             self.instruments)
+        finally:
+            self.diagnostics.end()
+
+    def fan(self):
+        """
+        Creates crossing lines between the contours without a boundary. CrossingLineFan.boundary() gives the same
+        result as run() for any last_pos and current_pos
+        :return: geo_tools.CrossingLineFan
+        """
+        with self.instruments.stage(inst.SEGMENT):
+            return FANS[self.engine](self.low_contour, self.high_contour, self.diagnostics, self.instruments)
 
     def __str__(self):
         return 'Current: '+str(self.current_feature)+' Last: '+str(self.last_feature)#+' High C: '+self.high_contour.elev+ \
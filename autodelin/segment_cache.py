@@ -0,0 +1,85 @@
+"""
+On-disk cache of segment results keyed by a hash of the segment inputs: clipped contour coordinates, boundary
+positions and engine. Rerunning a reach after editing one BFE or extent only recomputes segments whose inputs changed.
+
+Usage:
+    import autodelin.logic as logic
+    from autodelin.segment_cache import SegmentCache
+    logic.set_segment_cache(SegmentCache('segment_cache'))
+
+Cache layout (directory):
+    <first two characters of key>/<key>.npy - (N, 2) float64 boundary coordinates
+"""
+import os
+import hashlib
+import numpy as np
+import geo_tools as gt
+
+# Part of every key. Bump when delineation changes so old results aren't reused
+CACHE_VERSION = 2
+
+
+class SegmentCache(object):
+    """
+    Segment result cache in cache_dir. Safe to share between SMP workers, results are written to a temporary file
+    and renamed into place. Write failures raise, delineation treats them as a cache miss.
+    """
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: string - cache directory, created if it doesn't exist
+        """
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(seg):
+        """
+        Returns hash of segment inputs
+        :param seg: segment.Segment
+        :return: string - hex digest
+        """
+        digest = hashlib.sha1()
+        digest.update(repr((CACHE_VERSION, seg.engine, float(seg.last_pos), float(seg.current_pos),
+                            seg.low_contour.coords.shape, seg.high_contour.coords.shape,
+                            gt.REFINE_TOLERANCE, gt.REFINE_MAX_ITERATIONS)).encode())
+        digest.update(np.ascontiguousarray(seg.low_contour.coords, dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(seg.high_contour.coords, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns cached boundary coordinates for key, None if not cached
+        :param key: string - from self.key()
+        :return: (N, 2) array or None
+        """
+        try:
+            return np.load(self._file_name(key))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, boundary):
+        """
+        Saves boundary for key
+        :param key: string - from self.key()
+        :param boundary: ADPolyline
+        """
+        file_name = self._file_name(key)
+        directory = os.path.dirname(file_name)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process beat us to it
+                pass
+        temp_name = file_name + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_name, 'wb') as out_file:
+            np.save(out_file, np.asarray(boundary.coords, dtype=np.float64))
+        try:
+            os.rename(temp_name, file_name)
+        except OSError:
+            # Windows won't rename over an existing file. It holds the result for the same key, keep it
+            os.remove(temp_name)
+            if not os.path.exists(file_name):
+                raise
+
+    def _file_name(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
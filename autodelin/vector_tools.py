@@ -0,0 +1,369 @@
+"""
+NumPy implementation of geo_tools.draw_line_between_contours(). Crossing lines are kept as rows of an (N, 2, 2) array
+(line, vertex, X/Y) and all vertex to contour projections are done in one batched point-to-segment calculation
+instead of one shapely project()/interpolate() per vertex. LinearReference does the same for stationing BFE/XS along
+the river.
+"""
+import numpy as np
+from shapely.geometry import LineString, box
+from shapely.strtree import STRtree
+import geo_tools as gt
+import diagnostics as diag
+import instrumentation as inst
+
+# Maximum number of point/segment pairs evaluated at once. Keeps the temporary arrays to a few tens of MB
+CHUNK_SIZE = 2 ** 20
+
+# Tolerance for parametric intersection tests. Intersections closer than this to the end of a line are treated as
+# touching the end, not crossing the line
+EPSILON = 1e-9
+
+
+def draw_line_between_contours(low_contour, high_contour, last_pos, current_pos, diagnostics=None, instruments=None):
+    """
+    Interpolates line from low contour to high_contour based on last_pos and current_pos. Same as
+    geo_tools.draw_line_between_contours() but uses array math instead of shapely for every vertex.
+    :param low_contour: ADPolyline for lower elevation contour
+    :param high_contour: ADPolyline for higher elevation contour
+    :param last_pos: float - position to begin at (first vertex) between high and low contour. Varies between 0.0 and
+                    1.0. 0 indicates begin at lower contour, 0.999 is almost at high contour
+    :param current_pos: float - position to end at (last vertex) between high and low contour
+    :param diagnostics: diagnostics sink, defaults to geo_tools.DIAGNOSTICS
+    :param instruments: stage timers and counters, defaults to geo_tools.INSTRUMENTS
+    :return: ADPolyline object
+    """
+    fan = crossing_line_fan(low_contour, high_contour, diagnostics, instruments)
+    return fan.boundary(last_pos, current_pos, diagnostics, instruments)
+
+
+def crossing_line_fan(low_contour, high_contour, diagnostics=None, instruments=None):
+    """
+    Creates, filters and sorts the crossing lines between low_contour and high_contour. Same as
+    geo_tools.crossing_line_fan() with array math
+    :param low_contour: ADPolyline for lower elevation contour
+    :param high_contour: ADPolyline for higher elevation contour
+    :param diagnostics: diagnostics sink, defaults to geo_tools.DIAGNOSTICS
+    :param instruments: stage timers and counters, defaults to geo_tools.INSTRUMENTS
+    :return: geo_tools.CrossingLineFan
+    """
+    if diagnostics is None:
+        diagnostics = gt.DIAGNOSTICS
+    if instruments is None:
+        instruments = gt.INSTRUMENTS
+    low = low_contour.coords
+    high = high_contour.coords
+    if diagnostics.enabled:
+        diagnostics.add(diag.LOW_CONTOUR, low)
+        diagnostics.add(diag.HIGH_CONTOUR, high)
+
+    # create perpendicular (crossing) lines from contour1 to contour2
+    x_lines1 = np.empty((len(low), 2, 2))
+    with instruments.stage(inst.CROSSING_LINES):
+        x_lines1[:, 0] = low
+        x_lines1[:, 1] = closest_points(low, high)
+    with instruments.stage(inst.REMOVE_INTERSECTING):
+        x_lines1 = x_lines1[~crosses_polyline(x_lines1, low)]
+    assert len(x_lines1) > 0
+
+    # create perpendicular (crossing) lines from contour2 to contour1
+    x_lines2 = np.empty((len(high), 2, 2))
+    with instruments.stage(inst.CROSSING_LINES):
+        x_lines2[:, 0] = closest_points(high, low)
+        x_lines2[:, 1] = high
+    with instruments.stage(inst.REMOVE_INTERSECTING):
+        x_lines2 = x_lines2[~crosses_polyline(x_lines2, high)]
+    assert len(x_lines2) > 0
+
+    if diagnostics.enabled:
+        diagnostics.add(diag.RAW_LINES, np.concatenate((x_lines1, x_lines2)))
+
+    # Combine both lists
+    with instruments.stage(inst.FILTER):
+        crossing_lines = _sort_lines(x_lines1, x_lines2, low, high)
+
+    if instruments.enabled:
+        vertices = len(low) + len(high)
+        unfiltered = len(x_lines1) + len(x_lines2)
+        instruments.count(inst.VERTICES, vertices)
+        instruments.count(inst.LINES_GENERATED, vertices)
+        instruments.count(inst.LINES_INTERSECTING, vertices - unfiltered)
+        instruments.count(inst.LINES_FILTERED, unfiltered - len(crossing_lines))
+
+    # Create last crossing line at BFE intercept on contour2
+    temp_line = np.array([[low[-1], high[-1]]])
+    if not _is_same_as(temp_line[0], crossing_lines[-1]):
+        crossing_lines = np.concatenate((crossing_lines, temp_line))
+
+    # Create first crossing line
+    temp_line = np.array([[low[0], high[0]]])
+    if not _is_same_as(temp_line[0], crossing_lines[0]):
+        crossing_lines = np.concatenate((temp_line, crossing_lines))
+
+    if diagnostics.enabled:
+        diagnostics.add(diag.CROSSING_LINES, crossing_lines)
+
+    # Add distances along contour1 to crossing lines
+    with instruments.stage(inst.CROSSING_LINES):
+        distance = project(crossing_lines[:, 0], low)
+    return gt.CrossingLineFan(crossing_lines, distance)
+
+
+def closest_points(points, polyline):
+    """
+    Returns the point on polyline closest to each point in points
+    :param points: (N, 2) array
+    :param polyline: (M, 2) array of polyline vertices
+    :return: (N, 2) array
+    """
+    index, t = _locate(points, polyline)
+    start = polyline[index]
+    return start + t[:, np.newaxis] * (polyline[index + 1] - start)
+
+
+def project(points, polyline):
+    """
+    Returns the distance along polyline to the point on polyline nearest each point in points. Array version of
+    ADPolyline.project()
+    :param points: (N, 2) array
+    :param polyline: (M, 2) array of polyline vertices
+    :return: (N,) array
+    """
+    index, t = _locate(points, polyline)
+    lengths = _lengths(polyline)
+    stations = np.zeros(len(polyline))
+    stations[1:] = np.cumsum(lengths)
+    return stations[index] + t * lengths[index]
+
+
+def interpolate(lines, normal_distance):
+    """
+    Returns point at normalized distance along each crossing line. Array version of
+    ADPolyline.point_at_distance(normalize=True) for two vertex lines
+    :param lines: (N, 2, 2) array of crossing lines
+    :param normal_distance: (N,) array - normalized distance along each line, 0.0 to 1.0
+    :return: (N, 2) array
+    """
+    t = np.clip(normal_distance, 0.0, 1.0)[:, np.newaxis]
+    return lines[:, 0] + t * (lines[:, 1] - lines[:, 0])
+
+
+def crosses_polyline(lines, polyline):
+    """
+    Tests each crossing line against polyline. Array version of ADPolyline.crosses(): a line crosses the polyline if
+    their interiors intersect at a point. Touching the ends of either line is not a cross.
+    :param lines: (N, 2, 2) array of crossing lines
+    :param polyline: (M, 2) array of polyline vertices
+    :return: (N,) boolean array
+    """
+    seg_start = polyline[:-1]
+    seg_end = polyline[1:]
+    last_seg = len(seg_start) - 1
+    result = np.zeros(len(lines), dtype=bool)
+    step = max(1, CHUNK_SIZE // max(1, len(seg_start)))
+    for i in range(0, len(lines), step):
+        chunk = lines[i:i + step]
+        t, u, valid = _intersect_params(chunk[:, 0, np.newaxis], chunk[:, 1, np.newaxis], seg_start, seg_end)
+        hit = valid & (t > EPSILON) & (t < 1 - EPSILON) & (u >= -EPSILON) & (u <= 1 + EPSILON)
+        # The first and last vertex of the polyline are its boundary, not its interior
+        hit[:, 0] &= u[:, 0] > EPSILON
+        hit[:, last_seg] &= u[:, last_seg] < 1 - EPSILON
+        result[i:i + step] = hit.any(axis=1)
+    return result
+
+
+def crossing_pairs(lines):
+    """
+    Finds all crossing lines that cross each other. Array version of calling ADPolyline.crosses() for every pair
+    :param lines: (N, 2, 2) array of crossing lines
+    :return: list of sets - indices of the lines that each line crosses
+    """
+    adjacency = [set() for _ in range(len(lines))]
+    step = max(1, CHUNK_SIZE // max(1, len(lines)))
+    for i in range(0, len(lines), step):
+        chunk = lines[i:i + step]
+        t, u, valid = _intersect_params(chunk[:, 0, np.newaxis], chunk[:, 1, np.newaxis], lines[:, 0], lines[:, 1])
+        hit = valid & (t > EPSILON) & (t < 1 - EPSILON) & (u > EPSILON) & (u < 1 - EPSILON)
+        for a, b in zip(*np.nonzero(hit)):
+            adjacency[i + a].add(b)
+    return adjacency
+
+
+def filter_crossing_lines(lines):
+    """
+    Removes intersecting crossing lines, preferentially removing lines that cross the most other lines. Removes the
+    same lines, in the same order, as geo_tools.FilterCrossingLines
+    :param lines: (N, 2, 2) array of crossing lines
+    :return: array of indices of remaining lines, in the order FilterCrossingLines leaves them
+    """
+    order = np.array(gt.greedy_filter(crossing_pairs(lines)), dtype=int)
+    assert len(order) > 0
+    return order
+
+
+def _sort_lines(x_lines1, x_lines2, low, high):
+    """
+    Merges x_lines1 and x_lines2, removes intersecting lines and sorts by distance along the contours
+    :param x_lines1: (N, 2, 2) array
+    :param x_lines2: (M, 2, 2) array
+    :param low: (I, 2) array - low contour vertices
+    :param high: (J, 2) array - high contour vertices
+    :return: (K, 2, 2) array
+    """
+    sorted_lines = np.concatenate((x_lines1, x_lines2))
+    sorted_lines = sorted_lines[filter_crossing_lines(sorted_lines)]
+    sorted_lines = sorted_lines[np.argsort(project(sorted_lines[:, 0], low), kind='mergesort')]
+    sorted_lines = sorted_lines[np.argsort(project(sorted_lines[:, 1], high), kind='mergesort')]
+    return sorted_lines
+
+
+def _locate(points, polyline):
+    """
+    Finds the closest segment of polyline for each point and the parametric position (0.0 to 1.0) along it of the
+    closest point. Ties go to the first segment, like shapely.
+    :param points: (N, 2) array
+    :param polyline: (M, 2) array of polyline vertices
+    :return: (N,) int array of segment indices, (N,) float array of positions along the segments
+    """
+    seg_start = polyline[:-1]
+    seg_vector = polyline[1:] - seg_start
+    seg_length_sq = (seg_vector ** 2).sum(axis=1)
+    # Zero length segments are just a point
+    safe_length_sq = np.where(seg_length_sq > 0, seg_length_sq, 1.0)
+
+    index = np.empty(len(points), dtype=int)
+    position = np.empty(len(points))
+    step = max(1, CHUNK_SIZE // max(1, len(seg_start)))
+    for i in range(0, len(points), step):
+        chunk = points[i:i + step, np.newaxis]
+        offset = chunk - seg_start
+        t = np.clip((offset * seg_vector).sum(axis=2) / safe_length_sq, 0.0, 1.0)
+        closest = seg_start + t[:, :, np.newaxis] * seg_vector
+        dist_sq = ((chunk - closest) ** 2).sum(axis=2)
+        nearest = dist_sq.argmin(axis=1)
+        index[i:i + step] = nearest
+        position[i:i + step] = t[np.arange(len(nearest)), nearest]
+    return index, position
+
+
+class LinearReference(object):
+    """
+    Linear referencing index for a polyline (river alignment): station at each vertex and an STRtree over the
+    segments. Intersections and stations for many lines are found in one batched calculation against only the nearby
+    segments, instead of a shapely intersection() and project() against the whole polyline for each line.
+    """
+    def __init__(self, coords):
+        """
+        :param coords: (M, 2) array - polyline vertices
+        """
+        self.coords = np.asarray(coords, dtype=float)
+        self.seg_start = self.coords[:-1]
+        self.seg_end = self.coords[1:]
+        self.seg_length = _lengths(self.coords)
+        self.stations = np.zeros(len(self.coords))
+        self.stations[1:] = np.cumsum(self.seg_length)
+        # Segment index, built on first use
+        self._tree = None
+        self._seg_index = None
+        self._seg_geos = None
+
+    def __getstate__(self):
+        """ The segment index is rebuilt on first use after unpickling """
+        state = self.__dict__.copy()
+        state['_tree'] = None
+        state['_seg_index'] = None
+        state['_seg_geos'] = None
+        return state
+
+    def _build_index(self):
+        geos = [LineString(x) for x in np.stack((self.seg_start, self.seg_end), axis=1)]
+        self._seg_index = dict((id(geo), i) for i, geo in enumerate(geos))
+        self._tree = STRtree(geos)
+        # Keep the geometries alive, the index is by id()
+        self._seg_geos = geos
+
+    def intersect(self, polylines):
+        """
+        Finds where each polyline crosses the indexed polyline
+        :param polylines: list of (K, 2) arrays
+        :return: list of (stations, points) per polyline - (C,) array of stations in increasing order and (C, 2)
+                 array of intersection points, C is 0 if the polyline doesn't cross
+        """
+        if self._tree is None:
+            self._build_index()
+
+        # Pair every segment of each polyline with the nearby indexed segments
+        owners = []
+        line_starts = []
+        line_ends = []
+        seg_ids = []
+        for i, coords in enumerate(polylines):
+            coords = np.asarray(coords, dtype=float)
+            minx, miny = coords.min(axis=0)
+            maxx, maxy = coords.max(axis=0)
+            candidates = [self._seg_index[id(geo)] for geo in self._tree.query(box(minx, miny, maxx, maxy))]
+            if not candidates:
+                continue
+            num_lines = len(coords) - 1
+            owners.append(np.repeat(i, num_lines * len(candidates)))
+            line_starts.append(np.repeat(coords[:-1], len(candidates), axis=0))
+            line_ends.append(np.repeat(coords[1:], len(candidates), axis=0))
+            seg_ids.append(np.tile(candidates, num_lines))
+
+        results = [(np.empty(0), np.empty((0, 2))) for _ in polylines]
+        if not owners:
+            return results
+        owners = np.concatenate(owners)
+        line_starts = np.concatenate(line_starts)
+        line_ends = np.concatenate(line_ends)
+        seg_ids = np.concatenate(seg_ids)
+
+        t, u, valid = _intersect_params(line_starts, line_ends, self.seg_start[seg_ids], self.seg_end[seg_ids])
+        hit = valid & (t >= -EPSILON) & (t <= 1 + EPSILON) & (u >= -EPSILON) & (u <= 1 + EPSILON)
+        owners = owners[hit]
+        seg_ids = seg_ids[hit]
+        u = np.clip(u[hit], 0.0, 1.0)
+        stations = self.stations[seg_ids] + u * self.seg_length[seg_ids]
+        points = self.seg_start[seg_ids] + u[:, np.newaxis] * (self.seg_end[seg_ids] - self.seg_start[seg_ids])
+
+        # Group by polyline. Hits at shared vertices are found twice, keep one per station
+        order = np.lexsort((stations, owners))
+        owners = owners[order]
+        stations = stations[order]
+        points = points[order]
+        keep = np.ones(len(stations), dtype=bool)
+        keep[1:] = (owners[1:] != owners[:-1]) | (np.round(stations[1:], gt.PRECISION) !=
+                                                  np.round(stations[:-1], gt.PRECISION))
+        owners = owners[keep]
+        stations = stations[keep]
+        points = points[keep]
+        bounds = np.searchsorted(owners, np.arange(len(polylines) + 1))
+        for i in np.unique(owners):
+            results[i] = (stations[bounds[i]:bounds[i + 1]], points[bounds[i]:bounds[i + 1]])
+        return results
+
+
+def _intersect_params(p1, p2, q1, q2):
+    """
+    Parametric intersection of lines p1-p2 and q1-q2. Inputs broadcast against each other.
+    :return: t - position along p, u - position along q, valid - False for parallel lines
+    """
+    r = p2 - p1
+    s = q2 - q1
+    qp = q1 - p1
+    denom = r[..., 0] * s[..., 1] - r[..., 1] * s[..., 0]
+    valid = denom != 0
+    safe_denom = np.where(valid, denom, 1.0)
+    t = (qp[..., 0] * s[..., 1] - qp[..., 1] * s[..., 0]) / safe_denom
+    u = (qp[..., 0] * r[..., 1] - qp[..., 1] * r[..., 0]) / safe_denom
+    return t, u, valid
+
+
+def _lengths(points):
+    """ Returns length of each segment between consecutive points """
+    return np.hypot(*np.diff(points, axis=0).T)
+
+
+def _is_same_as(line1, line2):
+    """ Array version of ADPolyline.is_same_as() for two vertex lines """
+    return (np.round(line1, gt.PRECISION) == np.round(line2, gt.PRECISION)).all()
+
@@ -0,0 +1,82 @@
+"""
+Measures the time to import an autodelin module in a fresh interpreter, and which heavy backends it loads.
+
+Usage (from the repository root):
+    python benchmarks/import_time.py [--module autodelin.interface] [--runs 10] [--target 0.25] [--json]
+
+Exits with status 1 if the median import time is over --target seconds.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Backends that should only be imported when first used
+HEAVY_MODULES = ['matplotlib.pyplot', 'pathos.multiprocessing', 'fiona']
+
+# Run in a fresh interpreter for every measurement so nothing is already imported
+SCRIPT = """
+import json, sys, time
+start = time.time()
+import {module}
+elapsed = time.time() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import(module, runs):
+    """
+    Imports module in runs new interpreters
+    :param module: string - module name
+    :param runs: int - number of measurements
+    :return: list of floats - seconds per import, list of strings - heavy modules loaded by the import
+    """
+    script = SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    times = []
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=REPO_ROOT)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        times.append(result['seconds'])
+        loaded.update(result['loaded'])
+    return times, sorted(loaded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time autodelin imports')
+    parser.add_argument('--module', default='autodelin.interface', help='module to import')
+    parser.add_argument('--runs', type=int, default=10, help='number of fresh interpreters to time')
+    parser.add_argument('--target', type=float, default=None, help='maximum allowed median import time, seconds')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    times, loaded = time_import(args.module, args.runs)
+    times.sort()
+    report = {'module': args.module,
+              'runs': args.runs,
+              'median': times[len(times) // 2],
+              'min': times[0],
+              'max': times[-1],
+              'heavy_modules_loaded': loaded,
+              'target': args.target}
+
+    if args.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print 'import', args.module
+        print '  median %.3f s, min %.3f s, max %.3f s over %d runs' % (report['median'], report['min'],
+                                                                       report['max'], args.runs)
+        if loaded:
+            print '  heavy modules loaded at import:', ', '.join(loaded)
+        if args.target is not None:
+            print '  target %.3f s' % args.target
+
+    if args.target is not None and report['median'] > args.target:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Times delineation by stage on fixed cases from the bundled data and on synthetic valleys, for each engine and worker
+count. Results are written as JSON so runs on different commits can be compared.
+
+Cases:
+    carp        - GHC carp BFEs, cross sections and extents with shapes/carp_contour_clip.shp, trimmed to BFE 5135
+                  to 5160 (the contour clip doesn't cover the rest of the reach)
+    trib        - shapes/ south tributary: bfe3, xs, extents and river with contour_s_trib_dslv.shp, whole reach
+    synthetic   - valley from synthetic_valley.py, size set with --bfes and --vertex-spacing
+
+Stages:
+    import      - reading shapefiles
+    select      - selecting BFE/XS for the reach, stations and sorting
+    prepare     - clipping contours between BFE/XS, both sides (logic._prepare_side)
+    run         - delineating segments, both sides (logic._run_segments)
+
+With --instrument, each run also has the per stage times and counts from autodelin.instrumentation (clipping,
+crossing lines, filtering, refinement, ...) under 'instruments'.
+
+Usage (from the repository root):
+    python benchmarks/run_benchmarks.py [--case carp trib synthetic] [--engine numpy shapely] [--workers 0 2 4]
+                                        [--repeat 1] [--bfes 40] [--vertex-spacing 5] [--instrument]
+                                        [--out results.json]
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import synthetic_valley as sv
+import autodelin.interface as ad
+import autodelin.logic as logic
+import autodelin.geo_tools as gt
+import autodelin.instrumentation as inst
+
+CARP = {'bfe_file': os.path.join(REPO_ROOT, 'GHC', 'carp_bfe.shp'),
+        'xs_file': os.path.join(REPO_ROOT, 'GHC', 'carp_XS.shp'),
+        'extent_file': os.path.join(REPO_ROOT, 'GHC', 'all_extents.shp'),
+        'profile': '100-yr',
+        'river_file': os.path.join(REPO_ROOT, 'GHC', 'ghc_mainstem.shp'),
+        'contour_file': os.path.join(REPO_ROOT, 'shapes', 'carp_contour_clip.shp'),
+        'contour_field': 'ContourEle',
+        'start': 5135,
+        'end': 5160}
+
+TRIB = {'bfe_file': os.path.join(REPO_ROOT, 'shapes', 'bfe3.shp'),
+        'xs_file': os.path.join(REPO_ROOT, 'shapes', 'xs.shp'),
+        'extent_file': os.path.join(REPO_ROOT, 'shapes', 'extents.shp'),
+        'profile': '100-yr',
+        'river_file': os.path.join(REPO_ROOT, 'shapes', 'river.shp'),
+        'contour_file': os.path.join(REPO_ROOT, 'shapes', 'contour_s_trib_dslv.shp'),
+        'contour_field': 'ContourEle'}
+
+
+class Timer(object):
+    """ Collects elapsed time by stage """
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, function, *args, **kwargs):
+        start = time.time()
+        result = function(*args, **kwargs)
+        self.stages[stage] = self.stages.get(stage, 0.) + time.time() - start
+        return result
+
+
+def run_case(case, engine, workers, instrument=False):
+    """
+    Delineates case and returns timings
+    :param case: dict - file names and import arguments, see CARP and synthetic_valley.files()
+    :param engine: string - crossing line engine
+    :param workers: int - number of SMP workers, 0 for none
+    :param instrument: bool - record per stage times and counts with autodelin.instrumentation
+    :return: dict
+    """
+    timer = Timer()
+    gt.set_instruments(inst.Instruments() if instrument else None)
+    mgr = ad.Manager()
+    mgr.engine = engine
+    mgr.workers = workers
+    # Keep pool start up out of the import time
+    mgr.fork_after_contours = False
+
+    timer.time('import', mgr.import_bfes, case['bfe_file'])
+    timer.time('import', mgr.import_xs, case['xs_file'])
+    timer.time('import', mgr.import_extents, case['extent_file'], case['profile'])
+    timer.time('import', mgr.import_single_river, case['river_file'])
+    timer.time('import', mgr.import_contours, case['contour_file'], case['contour_field'])
+
+    timer.time('select', mgr._select_bfe_xs)
+    timer.time('select', mgr._calc_stations)
+    timer.time('select', mgr._sort_bfe_and_xs)
+    if case.get('start') is not None:
+        timer.time('select', mgr.trim_bfe_xs, start=case['start'], end=case['end'])
+
+    # Upstream order, as logic.delineate() does
+    combo_list = mgr.combo_list
+    if combo_list[0].elevation > combo_list[-1].elevation:
+        combo_list = combo_list[::-1]
+
+    timer.time('pool_start', mgr.start_workers)
+    try:
+        boundary = []
+        for side in (logic.LEFT, logic.RIGHT):
+            jobs = timer.time('prepare', logic._prepare_side, combo_list, mgr.contours, side, engine, mgr._pool)
+            boundary += timer.time('run', logic._run_segments, jobs, workers, mgr._pool)
+    finally:
+        mgr.close()
+
+    delineate = timer.stages['prepare'] + timer.stages['run']
+    result = {'engine': engine,
+              'workers': workers,
+              'bfe_xs': len(mgr.combo_list),
+              'segments': len(boundary),
+              'boundary_vertices': sum(len(x.coords) for x in boundary),
+              'stages': timer.stages,
+              'delineate': delineate,
+              'per_segment': timer.stages['run'] / max(len(boundary), 1),
+              'segments_per_second': len(boundary) / delineate if delineate else None}
+    if instrument:
+        result['instruments'] = gt.INSTRUMENTS.snapshot()
+        gt.set_instruments(None)
+    return result
+
+
+def add_scaling(runs):
+    """ Adds speed up over the run with fewest workers for each case and engine """
+    groups = {}
+    for run in runs:
+        groups.setdefault((run['case'], run['engine']), []).append(run)
+    for group in groups.values():
+        base = min(group, key=lambda x: x['workers'])
+        for run in group:
+            run['speedup'] = base['delineate'] / run['delineate'] if run['delineate'] else None
+
+
+def git_commit():
+    """ Returns current commit hash or None """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark autodelin delineation')
+    parser.add_argument('--case', nargs='+', default=['carp', 'trib', 'synthetic'],
+                        choices=['carp', 'trib', 'synthetic'])
+    parser.add_argument('--engine', nargs='+', default=['numpy'], help='crossing line engines to time')
+    parser.add_argument('--workers', nargs='+', type=int, default=[0], help='worker counts to time')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each combination, fastest is kept')
+    parser.add_argument('--bfes', type=int, default=40, help='synthetic case: number of BFEs')
+    parser.add_argument('--xs-per-bfe', type=int, default=1, help='synthetic case: cross sections between BFEs')
+    parser.add_argument('--vertex-spacing', type=float, default=5., help='synthetic case: contour vertex spacing')
+    parser.add_argument('--instrument', action='store_true', help='record per stage times and counts')
+    parser.add_argument('--out', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix='autodelin-bench-')
+    try:
+        cases = {'carp': CARP, 'trib': TRIB}
+        if 'synthetic' in args.case:
+            valley = sv.make_valley(temp_dir, bfes=args.bfes, xs_per_bfe=args.xs_per_bfe,
+                                    vertex_spacing=args.vertex_spacing)
+            cases['synthetic'] = valley
+
+        runs = []
+        # Delineation prints progress, keep it out of the results
+        stdout = sys.stdout
+        for name in args.case:
+            for engine in args.engine:
+                for workers in args.workers:
+                    best = None
+                    for _ in range(args.repeat):
+                        sys.stdout = open(os.devnull, 'w')
+                        try:
+                            run = run_case(cases[name], engine, workers, args.instrument)
+                        finally:
+                            sys.stdout.close()
+                            sys.stdout = stdout
+                        if best is None or run['delineate'] < best['delineate']:
+                            best = run
+                    best['case'] = name
+                    runs.append(best)
+                    print '%-10s %-8s workers=%-2d %3d segments  prepare %.3f s  run %.3f s  %.4f s/segment' % \
+                        (name, engine, workers, best['segments'], best['stages']['prepare'], best['stages']['run'],
+                         best['per_segment'])
+        add_scaling(runs)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    result = {'commit': git_commit(),
+              'date': datetime.datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'cpus': multiprocessing.cpu_count(),
+              'synthetic': {'bfes': args.bfes, 'xs_per_bfe': args.xs_per_bfe, 'vertex_spacing': args.vertex_spacing},
+              'runs': runs}
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            json.dump(result, out_file, indent=2, sort_keys=True)
+    else:
+        print json.dumps(result, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Generates a synthetic valley as shapefiles for benchmarking: contours, BFEs, cross sections with extents and the river
+centerline. The valley floor rises along x with a parabolic cross profile, so every contour is a single U shaped line
+and the floodplain boundary is a straight line at a known distance from the river.
+
+    z(x, y) = slope * x + y**2 / width_factor
+    water surface(x) = slope * x + depth
+
+Reach length scales with --bfes, vertex density with --vertex-spacing. Field names match the GHC data so the files can
+be used with the usual Manager import calls, see files() for the arguments.
+
+Usage (from the repository root):
+    python benchmarks/synthetic_valley.py out_dir [--bfes 20] [--bfe-spacing 200] [--xs-per-bfe 1]
+                                                  [--vertex-spacing 5] [--half-width 100] [--depth 3]
+"""
+import argparse
+import math
+import os
+import numpy as np
+import fiona
+
+BFE_FILE = 'bfe.shp'
+XS_FILE = 'xs.shp'
+EXTENT_FILE = 'extents.shp'
+RIVER_FILE = 'river.shp'
+CONTOUR_FILE = 'contours.shp'
+
+PROFILE = '100-yr'
+FIRST_ELEVATION = 1000
+
+
+def make_valley(out_dir, bfes=20, bfe_spacing=200., xs_per_bfe=1, vertex_spacing=5., half_width=100., depth=3.):
+    """
+    Writes synthetic valley shapefiles to out_dir
+    :param out_dir: string - output directory, created if it doesn't exist
+    :param bfes: int - number of BFEs, one per foot of rise
+    :param bfe_spacing: float - distance between BFEs along the river
+    :param xs_per_bfe: int - number of cross sections between each pair of BFEs
+    :param vertex_spacing: float - distance between contour vertices across the valley
+    :param half_width: float - distance from river to floodplain boundary
+    :param depth: float - water depth at the river, must be more than 1
+    :return: dict - file names and counts, see files()
+    """
+    if depth <= 1:
+        raise ValueError('depth must be more than 1 so the BFEs cross the contour below them')
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    slope = 1. / bfe_spacing
+    width_factor = half_width ** 2 / depth
+    # Water surface elevation is FIRST_ELEVATION at x = 0
+    z0 = FIRST_ELEVATION - depth
+
+    def ground_x(elevation, y):
+        """ x where contour at elevation is y from the river """
+        return (elevation - z0 - y ** 2 / width_factor) / slope
+
+    first_x = 0.
+    last_x = (bfes - 1) * bfe_spacing
+    # Cross sections reach past the next contour up
+    xs_half_width = math.sqrt((depth + 2) * width_factor)
+    valley_half_width = math.sqrt((depth + 4) * width_factor)
+
+    # Contours, one U shaped line per foot, apex on the river pointing upstream
+    contours = []
+    y = np.arange(0., valley_half_width + vertex_spacing, vertex_spacing)
+    y = np.concatenate((-y[:0:-1], y))
+    for elevation in range(FIRST_ELEVATION - 2, FIRST_ELEVATION + bfes + 2):
+        coords = np.column_stack((ground_x(elevation, y), y))
+        contours.append((elevation, coords))
+
+    # BFEs end where they meet the contour at their elevation, first point is the left bank (+y)
+    bfe_lines = []
+    for i in range(bfes):
+        x = first_x + i * bfe_spacing
+        bfe_lines.append((FIRST_ELEVATION + i, [(x, half_width), (x, -half_width)]))
+
+    # Cross sections between BFEs
+    xs_lines = []
+    extents = []
+    for i in range(bfes - 1):
+        for j in range(xs_per_bfe):
+            x = first_x + (i + (j + 1.) / (xs_per_bfe + 1)) * bfe_spacing
+            xs_id = round(x, 3)
+            elevation = FIRST_ELEVATION + slope * x
+            xs_lines.append((xs_id, [(x, xs_half_width), (x, -xs_half_width)]))
+            extents.append((xs_id, 'left', elevation, (x, half_width)))
+            extents.append((xs_id, 'right', elevation, (x, -half_width)))
+
+    river = [(first_x - bfe_spacing, 0.), (last_x + bfe_spacing, 0.)]
+
+    # Write shapefiles
+    _write(os.path.join(out_dir, CONTOUR_FILE), 'LineString', {'ContourEle': 'float'},
+           [({'ContourEle': float(e)}, {'type': 'LineString', 'coordinates': [tuple(p) for p in c.tolist()]})
+            for e, c in contours])
+    _write(os.path.join(out_dir, BFE_FILE), 'LineString', {'Elevation': 'float'},
+           [({'Elevation': float(e)}, {'type': 'LineString', 'coordinates': c}) for e, c in bfe_lines])
+    _write(os.path.join(out_dir, XS_FILE), 'LineString', {'ProfileM': 'float'},
+           [({'ProfileM': x}, {'type': 'LineString', 'coordinates': c}) for x, c in xs_lines])
+    _write(os.path.join(out_dir, EXTENT_FILE), 'Point',
+           {'XS_ID': 'float', 'Profile': 'str:20', 'Position': 'str:10', 'Elevation': 'float'},
+           [({'XS_ID': x, 'Profile': PROFILE, 'Position': pos, 'Elevation': e}, {'type': 'Point', 'coordinates': p})
+            for x, pos, e, p in extents])
+    _write(os.path.join(out_dir, RIVER_FILE), 'LineString', {'Name': 'str:20'},
+           [({'Name': 'synthetic'}, {'type': 'LineString', 'coordinates': river})])
+
+    result = files(out_dir)
+    result.update({'bfes': len(bfe_lines),
+                   'cross_sections': len(xs_lines),
+                   'contours': len(contours),
+                   'contour_vertices': int(sum(len(c) for _, c in contours))})
+    return result
+
+
+def files(out_dir):
+    """
+    Returns file names and import arguments for a valley made by make_valley()
+    :param out_dir: string - directory passed to make_valley()
+    :return: dict
+    """
+    return {'bfe_file': os.path.join(out_dir, BFE_FILE),
+            'xs_file': os.path.join(out_dir, XS_FILE),
+            'extent_file': os.path.join(out_dir, EXTENT_FILE),
+            'profile': PROFILE,
+            'river_file': os.path.join(out_dir, RIVER_FILE),
+            'contour_file': os.path.join(out_dir, CONTOUR_FILE),
+            'contour_field': 'ContourEle'}
+
+
+def _write(file_name, geometry_type, properties, records):
+    """
+    Writes records to shapefile
+    :param file_name: string
+    :param geometry_type: string - fiona geometry type
+    :param properties: dict - fiona property schema
+    :param records: list of (properties, geometry) tuples
+    """
+    schema = {'geometry': geometry_type, 'properties': properties}
+    with fiona.open(file_name, 'w', driver='ESRI Shapefile', schema=schema) as out:
+        out.writerecords([{'properties': p, 'geometry': g} for p, g in records])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic valley shapefiles')
+    parser.add_argument('out_dir', help='output directory')
+    parser.add_argument('--bfes', type=int, default=20, help='number of BFEs (reach length)')
+    parser.add_argument('--bfe-spacing', type=float, default=200., help='distance between BFEs')
+    parser.add_argument('--xs-per-bfe', type=int, default=1, help='cross sections between each pair of BFEs')
+    parser.add_argument('--vertex-spacing', type=float, default=5., help='contour vertex spacing')
+    parser.add_argument('--half-width', type=float, default=100., help='distance from river to floodplain boundary')
+    parser.add_argument('--depth', type=float, default=3., help='water depth at river')
+    args = parser.parse_args()
+
+    result = make_valley(args.out_dir, bfes=args.bfes, bfe_spacing=args.bfe_spacing, xs_per_bfe=args.xs_per_bfe,
+                         vertex_spacing=args.vertex_spacing, half_width=args.half_width, depth=args.depth)
+    print result['bfes'], 'BFEs,', result['cross_sections'], 'cross sections,', result['contours'], 'contours with', \
+        result['contour_vertices'], 'vertices written to', args.out_dir
+
+
+if __name__ == '__main__':
+    main()